@@ -0,0 +1,216 @@
+"""Versioned JSON API, under /api/v1.
+
+Responses carry only what a client needs to draw a list, read straight from
+the columns involved rather than through full ORM objects:
+
+- messages: ``{"id", "text", "timestamp", "likes", "user": {"id", "username", "image_url"}}``
+- users: ``{"id", "username", "image_url"}``
+
+Message ids are 64-bit (see `snowflake`), more than a JavaScript number
+holds exactly, so they are sent as strings.
+
+Lists come as ``{"data": [...], "next": ...}``. Pass ``next`` back to get
+the following page: as ``?before=`` for message lists (newest first; a
+user's likes by when they were liked) and
+``?after=`` for user lists (by id); it is null on the last page. ``?limit=``
+sets the page size, up to `MAX_LIMIT`. User search is ranked rather than
+ordered, so it pages with ``?page=`` instead.
+
+As on the site, the home timeline and who follows whom are only for
+logged-in users; other clients get a 401. A user's likes are public.
+"""
+
+from flask import Blueprint, abort, g, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+from assets import asset_url
+import pagination
+import search
+import timeline
+from replicas import replica_reads
+from models import db, User, Message, Follows, Likes
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.like_count,
+    User.id.label('user_id'),
+    User.username,
+    User.image_url,
+)
+
+USER_COLUMNS = (User.id, User.username, User.image_url)
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def message_json(row):
+    return {
+        'id': str(row.id),
+        'text': row.text,
+        'timestamp': row.timestamp.isoformat(),
+        'likes': row.like_count,
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': asset_url(row.image_url),
+        },
+    }
+
+
+def user_json(row):
+    return {'id': row.id, 'username': row.username, 'image_url': asset_url(row.image_url)}
+
+
+def page_limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    return min(max(limit, 1), MAX_LIMIT)
+
+
+def before_cursor(types=pagination.ID_KEY):
+    """The ``?before=`` message cursor, if any; 400 if it is malformed."""
+
+    token = request.args.get('before')
+    if token is None:
+        return None
+    cursor = pagination.decode_cursor(token, types)
+    if cursor is None:
+        abort(400, "Malformed cursor")
+    return cursor
+
+
+def message_page(query, user_id, order=(Message.id,)):
+    """One page of `query`'s messages, newest first, as a JSON response.
+
+    `order` names the columns the page is sorted and keyed on. The messages
+    are about user `user_id`: an empty page 404s if there is no such user.
+    """
+
+    limit = page_limit()
+    keys = [column.label(f'page_key{n}') for n, column in enumerate(order)]
+    types = tuple(column.type.python_type for column in order)
+    query = pagination.before(query, before_cursor(types), *order)
+    rows = (query
+            .add_columns(*keys)
+            .order_by(*[column.desc() for column in order])
+            .limit(limit + 1)
+            .all())
+    if not rows:
+        require_user(user_id)
+    return message_list(rows, limit,
+                        key=lambda row: tuple(getattr(row, key.name) for key in keys))
+
+
+def message_list(rows, limit, key=None):
+    rows, next_cursor = pagination.next_page(rows, limit, key)
+    return jsonify(data=[message_json(row) for row in rows], next=next_cursor)
+
+
+def user_page(query, user_id):
+    """One page of `query`'s users, by id, as a JSON response.
+
+    Like `message_page`, 404s on an empty page if user `user_id` is missing.
+    """
+
+    limit = page_limit()
+    after = request.args.get('after', 0, type=int)
+    rows = (query
+            .filter(User.id > after, User.deleted_at.is_(None))
+            .order_by(User.id)
+            .limit(limit + 1)
+            .all())
+    if not rows:
+        require_user(user_id)
+    rows, more = rows[:limit], len(rows) > limit
+    return jsonify(data=[user_json(row) for row in rows],
+                   next=rows[-1].id if more else None)
+
+
+def require_user(user_id):
+    """404 unless user `user_id` exists (and hasn't deleted their account)."""
+
+    if (db.session
+            .query(User.id)
+            .filter(User.id == user_id, User.deleted_at.is_(None))
+            .scalar()) is None:
+        abort(404, "No such user")
+
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    return jsonify(error=error.description), error.code
+
+
+@api.route('/timeline')
+@replica_reads
+def home_timeline():
+    """The logged-in user's home timeline."""
+
+    if not g.user:
+        abort(401, "Log in to see your timeline")
+
+    limit = page_limit()
+    rows = timeline.home_messages(g.user.id, limit=limit + 1,
+                                  cursor=before_cursor(), columns=MESSAGE_COLUMNS)
+    return message_list(rows, limit)
+
+
+@api.route('/users/<int:user_id>/messages')
+@replica_reads
+def user_messages(user_id):
+    return message_page(timeline
+                        .messages_query(MESSAGE_COLUMNS)
+                        .filter(Message.user_id == user_id), user_id)
+
+
+@api.route('/users/<int:user_id>/likes')
+@replica_reads
+def user_likes(user_id):
+    return message_page(timeline
+                        .messages_query(MESSAGE_COLUMNS)
+                        .join(Likes, Likes.message_id == Message.id)
+                        .filter(Likes.user_id == user_id), user_id,
+                        order=(Likes.timestamp, Likes.message_id))
+
+
+@api.route('/users/<int:user_id>/following')
+@replica_reads
+def user_following(user_id):
+    if not g.user:
+        abort(401, "Log in to see who users follow")
+
+    return user_page(db.session
+                     .query(*USER_COLUMNS)
+                     .join(Follows, Follows.user_being_followed_id == User.id)
+                     .filter(Follows.user_following_id == user_id), user_id)
+
+
+@api.route('/users/<int:user_id>/followers')
+@replica_reads
+def user_followers(user_id):
+    if not g.user:
+        abort(401, "Log in to see who users follow")
+
+    return user_page(db.session
+                     .query(*USER_COLUMNS)
+                     .join(Follows, Follows.user_following_id == User.id)
+                     .filter(Follows.user_being_followed_id == user_id), user_id)
+
+
+@api.route('/users/search')
+@replica_reads
+def user_search():
+    """Users whose username contains ``?q=``, best matches first."""
+
+    term = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    if not term or page < 1:
+        abort(400, "Give a search term and a page of 1 or more")
+
+    users, has_more = search.search_users(term, page, page_limit())
+    return jsonify(data=[user_json(user) for user in users],
+                   next=page + 1 if has_more else None)
@@ -1,43 +1,98 @@
 import os
+from functools import wraps
+from urllib.parse import urlparse
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask import (Blueprint, Flask, abort, current_app, flash, g, jsonify, redirect,
+                   render_template, request, session, url_for)
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
 from models import db, connect_db, User, Message, Follows, Likes
+from api import api
+import assets
+import caching
+import compression
+import counters
+import deletion
+import fragments
+import instrumentation
+import jobs
+import likes
+import pagination
+import replicas
+from replicas import replica_reads
+from user_cache import lazy_user, user_rows
+import search
+import snowflake
+import timeline
 
 CURR_USER_KEY = "curr_user"
+MESSAGES_PER_PAGE = 100
+USERS_PER_PAGE = 48
 
-app = Flask(__name__)
+views = Blueprint('views', __name__, cli_group=None)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler'
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = 'abc12345'
+def create_app(config=None):
+    """Build a Warbler app.
 
+    `config` is a settings class or its import path; by default the one
+    named by ``WARBLER_CONFIG``, else `config.Config`.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(config or os.environ.get('WARBLER_CONFIG', 'config.Config'))
 
-connect_db(app)
+    connect_db(app)
+    instrumentation.init_app(app)
+    fragments.init_app(app)
+    caching.init_app(app)
+    assets.init_app(app)
+    compression.init_app(app)
+    jobs.init_app(app)
+    replicas.init_app(app)
+    snowflake.init_app(app)
+    app.register_blueprint(api)
+    app.register_blueprint(views)
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user is only loaded once something uses `g.user`.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = lazy_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+def fresh_user(view):
+    """Decorator: load `g.user` from the database, not `user_rows`.
+
+    For views that change data: the cached row may be up to a TTL behind
+    writes made in other worker processes.
+    """
+
+    @wraps(view)
+    def with_fresh_user(*args, **kwargs):
+        if CURR_USER_KEY in session:
+            g.user = lazy_user(session[CURR_USER_KEY], fresh=True)
+        return view(*args, **kwargs)
+
+    return with_fresh_user
+
+
 def do_login(user):
     """Log in user."""
 
@@ -48,11 +103,12 @@ def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
+        user_rows.invalidate(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
-        
 
 
-@app.route('/signup', methods=["GET", "POST"])
+
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -72,7 +128,7 @@ def signup():
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=form.image_url.data or None,
             )
             db.session.commit()
 
@@ -88,7 +144,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -100,6 +156,8 @@ def login():
         
 
         if user:
+            # authenticate() may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             
@@ -110,7 +168,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
     do_logout()
@@ -118,38 +176,77 @@ def logout():
     return redirect('/login')
 
 
+def page_cursor():
+    """Decode the `before` pagination cursor from the querystring, if any."""
+
+    token = request.args.get('before')
+    if not token:
+        return None
+
+    cursor = pagination.decode_cursor(token)
+    if cursor is None:
+        abort(400)
+    return cursor
+
+
+def active_user_or_404(user_id, *options):
+    """User `user_id`, unless there is none or they deleted their account."""
+
+    return (User
+            .query
+            .options(*options)
+            .filter(User.id == user_id, User.deleted_at.is_(None))
+            .first_or_404())
+
+
 ##############################################################################
 # General user routes:
 
-@app.route('/users/<int:user_id>/edit', methods = ["GET", "POST"])
+@views.route('/users/<int:user_id>/edit', methods = ["GET", "POST"])
+@fresh_user
 def user_edit(user_id):
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    original_user = User.query.get_or_404(user_id)
+    original_user = User.query.populate_existing().get_or_404(user_id)
     form = UserEditForm()
     if form.validate_on_submit():
         entered_password = form.password.data
         user = User.authenticate(original_user.username, entered_password)
         if user:
+            # In SQL: the session's copy may be another worker's stale
+            # cached row, and the version must move past what's stored.
+            (User
+             .query
+             .filter(User.id == user.id)
+             .update({User.profile_version: User.profile_version + 1},
+                     synchronize_session=False))
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data
             user.header_image_url = form.header_image_url.data
             user.bio = form.bio.data
             db.session.commit()
-            return redirect(url_for('users_show', user_id = user.id))
+            user_rows.invalidate(user.id)
+            return redirect(url_for('views.users_show', user_id = user.id))
         else:
                 flash("Access unauthorized.", "danger")
                 return redirect("/")
     return render_template("/users/edit.html", form=form)
 
-@app.route('/users/<int:user_id>/likes')
+@views.route('/users/<int:user_id>/likes')
+@replica_reads
 def show_user_likes(user_id):
-    user = User.query.get_or_404(user_id)
-    liked_warbles = user.likes
+    active_user_or_404(user_id)
+    liked_warbles = (timeline
+                     .messages_query()
+                     .join(Likes, Likes.message_id == Message.id)
+                     .filter(Likes.user_id == user_id)
+                     .order_by(Likes.timestamp.desc(), Likes.message_id.desc())
+                     .options(joinedload(Message.user))
+                     .all())
 
     return render_template('/users/likes.html', liked_warbles = liked_warbles)
 
@@ -157,41 +254,84 @@ def show_user_likes(user_id):
     
 
 
-@app.route('/users')
+@views.route('/users')
+@replica_reads
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and a
+    'page' param for later pages of results.
     """
 
-    search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
+    term = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400)
+
+    if not term:
+        users = (User
+                 .query
+                 .filter(User.deleted_at.is_(None))
+                 .order_by(User.id)
+                 .offset((page - 1) * USERS_PER_PAGE)
+                 .limit(USERS_PER_PAGE + 1)
+                 .all())
+        has_more = len(users) > USERS_PER_PAGE
+        users = users[:USERS_PER_PAGE]
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_more = search.search_users(term, page, USERS_PER_PAGE)
 
-    return render_template('users/index.html', users=users)
+    if g.user:
+        g.user.follow_state.prime(user.id for user in users)
 
+    caching.validate(term, page, has_more,
+                     [(user.id, user.profile_version) for user in users],
+                     [g.user.is_following(user) for user in users] if g.user else None)
 
-@app.route('/users/<int:user_id>')
+    return compression.stream_template('users/index.html', users=users, q=term,
+                                       page=page, has_more=has_more)
+
+
+@views.route('/users/<int:user_id>')
+@replica_reads
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    # The newest message id goes into the ETag, so a page that lost one
+    # message and gained another still looks changed.
+    newest_message_id = (db.session
+                         .query(func.max(Message.id))
+                         .filter(Message.user_id == User.id)
+                         .correlate(User)
+                         .as_scalar())
+    user, newest_message_id = (db.session
+                               .query(User, newest_message_id)
+                               .filter(User.id == user_id, User.deleted_at.is_(None))
+                               .first_or_404())
+    if g.user:
+        g.user.follow_state.prime([user.id])
+
+    caching.validate(user.id, user.profile_version, newest_message_id,
+                     user.messages_count, user.following_count,
+                     user.followers_count, user.likes_count,
+                     g.user and g.user.is_following(user))
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
+    query = Message.query.filter(Message.user_id == user_id)
+    query = pagination.before(query, page_cursor(), Message.id)
+    messages = (query
+                .order_by(Message.id.desc())
+                .limit(MESSAGES_PER_PAGE + 1)
                 .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages, next_cursor = pagination.next_page(messages, MESSAGES_PER_PAGE)
 
+    return compression.stream_template('users/show.html', user=user,
+                                       messages=messages, next_cursor=next_cursor)
 
-@app.route('/users/<int:user_id>/following')
+
+@views.route('/users/<int:user_id>/following')
+@replica_reads
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -199,11 +339,13 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id, selectinload(User.following))
+    g.user.follow_state.prime([user.id] + [followed.id for followed in user.following])
     return render_template('users/following.html', user=user)
 
 
-@app.route('/users/<int:user_id>/followers')
+@views.route('/users/<int:user_id>/followers')
+@replica_reads
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -211,11 +353,13 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id, selectinload(User.followers))
+    g.user.follow_state.prime([user.id] + [follower.id for follower in user.followers])
     return render_template('users/followers.html', user=user)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['GET','POST'])
+@views.route('/users/follow/<int:follow_id>', methods=['GET','POST'])
+@fresh_user
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -223,17 +367,21 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    to_follow_user = User.query.get_or_404(follow_id)
+    to_follow_user = active_user_or_404(follow_id)
     # below single line was the old way, appending to a list
     # g.user.following.append(followed_user)
     new_follow = Follows(user_being_followed_id = to_follow_user.id, user_following_id = g.user.id)
     db.session.add(new_follow)
+    counters.adjust(g.user.id, following=1)
+    counters.adjust(to_follow_user.id, followers=1)
+    jobs.enqueue('timeline.add_follow', follower_id=g.user.id, followed_id=to_follow_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['GET','POST'])
+@views.route('/users/stop-following/<int:follow_id>', methods=['GET','POST'])
+@fresh_user
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -247,34 +395,42 @@ def stop_following(follow_id):
     follow_to_remove = Follows.query.get((followed_user.id, g.user.id))
     
     db.session.delete(follow_to_remove)
+    counters.adjust(g.user.id, following=-1)
+    counters.adjust(followed_user.id, followers=-1)
+    timeline.followers_dropped([followed_user.id])
+    timeline.remove_follow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 # This should be covered in user_edit
-# @app.route('/users/profile', methods=["GET", "POST"])
+# @views.route('/users/profile', methods=["GET", "POST"])
 # def profile():
 #     """Update profile for current user."""
 
 #     # IMPLEMENT THIS
 
 
-@app.route('/users/delete', methods=["GET","POST"])
+@views.route('/users/delete', methods=["GET","POST"])
+@fresh_user
 def delete_user():
-    """Delete user. Need to delete all their likes, likes on their messages,
-    all follows, and all messages"""
+    """Delete user: mark the account deleted and log out.
+
+    Their messages, likes and follows are removed later by a background
+    job, `deletion.purge`.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get(g.user.id)
-    
 
     do_logout()
 
-    db.session.delete(user)
+    deletion.mark_deleted(user)
     db.session.commit()
+    user_rows.invalidate(user.id)
 
     return redirect("/signup")
 
@@ -283,29 +439,55 @@ def delete_user():
 # Messages routes:
 
 
-@app.route('/users/add_like/<int:message_id>', methods = ["GET","POST"])
+@views.route('/users/add_like/<int:message_id>', methods = ["GET","POST"])
+@fresh_user
 def like_unlike_message(message_id):
     if not g.user:
         flash("Liking not allowed!!", "danger")
         return redirect("/")
-    user_likes = User.query.get(g.user.id).likes
-    message = Message.query.get_or_404(message_id)
-    if message not in user_likes:
-        like = Likes(user_id = g.user.id, message_id = message_id)
-        db.session.add(like)
-        db.session.commit()
-        flash('liked')
-        return redirect('/')
-    else:
-        
-        delete_like = Likes.query.filter(Likes.message_id == message_id, Likes.user_id == g.user.id).first()
-        db.session.delete(delete_like)
-        db.session.commit()
-        flash('unliked')
-        return redirect('/')
+
+    result = likes.toggle(g.user.id, message_id)
+    if result is None:
+        abort(404)
+    db.session.commit()
+
+    liked, like_count = result
+    flash('liked' if liked else 'unliked')
+    return redirect(back_url())
 
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/api/messages/<int:message_id>/like', methods=["POST"])
+@fresh_user
+def api_like_unlike_message(message_id):
+    """Toggle the current user's like on a message.
+
+    Responds with the new state, e.g. {"message_id": "1", "liked": true, "likes": 3};
+    message ids are strings, as in the JSON API.
+    """
+
+    if not g.user:
+        return jsonify(error="Liking not allowed!!"), 401
+
+    result = likes.toggle(g.user.id, message_id)
+    if result is None:
+        return jsonify(error="No such message"), 404
+    db.session.commit()
+
+    liked, like_count = result
+    return jsonify(message_id=str(message_id), liked=liked, likes=like_count)
+
+
+def back_url():
+    """The page the request came from, if it is on this site; else home."""
+
+    referrer = request.referrer
+    if referrer and urlparse(referrer).netloc == request.host:
+        return referrer
+    return url_for('views.homepage')
+
+
+@views.route('/messages/new', methods=["GET", "POST"])
+@fresh_user
 def messages_add():
     """Add a message:
 
@@ -321,6 +503,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        counters.adjust(g.user.id, messages=1)
+        jobs.enqueue('timeline.push_message', message_id=msg.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -328,15 +513,25 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@views.route('/messages/<int:message_id>', methods=["GET"])
+@replica_reads
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.options(joinedload(Message.user)).get_or_404(message_id)
+    if msg.user.deleted_at is not None:
+        abort(404)
+    if g.user:
+        g.user.follow_state.prime([msg.user_id])
+
+    caching.validate(msg.id, msg.user.profile_version,
+                     g.user and g.user.is_following(msg.user))
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
+@fresh_user
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -345,8 +540,11 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    counters.message_deleted(msg)
+    timeline.remove_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    fragments.cards.delete(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -355,48 +553,63 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
+@views.route('/')
+@replica_reads
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, older pages
+      via the `before` cursor in the querystring
     """
 
     if g.user:
-        # old subquery
-        subquery = db.session.query(Follows.user_being_followed_id).filter(Follows.user_following_id == g.user.id).subquery()
-        # subquery = db.execute(select(Follows.user_being_followed_id).where(Follows.user_following_id == g.user.id))
-
-        liked_messages = Likes.query.filter(Likes.user_id == g.user.id)
-        liked_message_ids = [liked_message.message_id for liked_message in liked_messages]
-        
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(subquery))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages, liked_message_ids = liked_message_ids)
+        messages = timeline.home_messages(g.user.id,
+                                          limit=MESSAGES_PER_PAGE + 1,
+                                          cursor=page_cursor())
+        messages, next_cursor = pagination.next_page(messages, MESSAGES_PER_PAGE)
+
+        liked_message_ids = {message_id for (message_id,) in (
+            db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == g.user.id,
+                    Likes.message_id.in_([msg.id for msg in messages]))
+            .all())}
+
+        return compression.stream_template('home.html', messages=messages,
+                                           liked_message_ids=liked_message_ids,
+                                           next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands
+
+
+@views.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Recompute every user's home timeline from follows and messages."""
+
+    timeline.rebuild()
+    db.session.commit()
+
+
+@views.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and precompress static files into static/dist/."""
+
+    built = assets.build(current_app.static_folder)
+    print(f"Built {len(built)} static files.")
+
+
+@views.cli.command('repair-counters')
+def repair_counters():
+    """Recompute every user's message, follow and like counters, and every
+    message's like count."""
+
+    repaired = counters.recount()
+    messages = counters.recount_likes()
+    db.session.commit()
+    print(f"Recounted {repaired} users and {messages} messages.")
@@ -0,0 +1,203 @@
+"""Fingerprinted, precompressed static files.
+
+``flask build-assets`` copies every file under static/ to static/dist/ with
+a hash of its contents in the name (``style.css`` becomes
+``style.3f2a9c1e4b7d.css``), plus ``.gz`` and, if the ``brotli`` package is
+installed, ``.br`` versions of text files. Stylesheet ``url(/static/...)``
+references are rewritten to the fingerprinted names first. A manifest maps
+each original name to its fingerprinted one.
+
+With a manifest present:
+
+- ``url_for('static', filename=...)``, `static_url`, and the `asset_url`
+  template filter give fingerprinted URLs;
+- those are served with a year-long ``immutable`` Cache-Control, since a
+  changed file gets a new name, and from the ``.br`` or ``.gz`` file when
+  the browser accepts that encoding.
+
+URLs stored in the database, like users' default images, keep the
+canonical ``/static/...`` path, since static/dist is rebuilt per deploy;
+they are fingerprinted as they are rendered. Earlier builds are left in
+place, so fingerprinted URLs that were handed out before keep working.
+Without a manifest static files are served as usual.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+STATIC_PREFIX = '/static/'
+HASH_LENGTH = 12
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Only text compresses usefully; images are compressed already.
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html'}
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)/static/([^'")]+)\1\s*\)""")
+
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+manifest = {}
+
+
+def fingerprint(path, content):
+    """`path` with a hash of `content` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    return f"{root}.{digest}{ext}"
+
+
+def source_files(static_folder):
+    """Paths, relative to `static_folder`, of the files to fingerprint.
+
+    Stylesheets come last, so the files they refer to are named by then.
+    """
+
+    paths = []
+    for directory, subdirectories, filenames in os.walk(static_folder):
+        relative = os.path.relpath(directory, static_folder)
+        if relative == DIST_DIR or relative.startswith(DIST_DIR + os.sep):
+            continue
+        for filename in filenames:
+            # Windows alternate data stream leftovers, e.g. "x.png:Zone.Identifier".
+            if ':' in filename:
+                continue
+            paths.append(os.path.normpath(os.path.join(relative, filename)).replace(os.sep, '/'))
+
+    return sorted(paths, key=lambda path: (path.endswith('.css'), path))
+
+
+def rewrite_css(content, names):
+    def replace(match):
+        quote, path = match.groups()
+        return f"url({quote}/static/{names.get(path, path)}{quote})"
+
+    return CSS_URL.sub(replace, content.decode('utf-8')).encode('utf-8')
+
+
+def write_variants(path, content):
+    """Write `content` to `path`, with .gz and .br copies where they help."""
+
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content, quality=11)))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+def build(static_folder):
+    """Fingerprint and compress everything in `static_folder`.
+
+    Returns the new manifest.
+    """
+
+    names = {}
+    for path in source_files(static_folder):
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = rewrite_css(content, names)
+
+        built = f"{DIST_DIR}/{fingerprint(path, content)}"
+        destination = os.path.join(static_folder, built)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        write_variants(destination, content)
+        names[path] = built
+
+    manifest_path = os.path.join(static_folder, DIST_DIR, MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(names, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return names
+
+
+def load_manifest(static_folder):
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST)
+    manifest.clear()
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest.update(json.load(f))
+
+
+def static_url(filename):
+    """URL path of static file `filename`, fingerprinted if it was built.
+
+    Unlike url_for, works without a request, e.g. in column defaults.
+    """
+
+    return f"/static/{manifest.get(filename, filename)}"
+
+
+def asset_url(url):
+    """`url` fingerprinted if it is a built static file's; else as it is.
+
+    For URLs stored in the database, such as users' images.
+    """
+
+    if url and url.startswith(STATIC_PREFIX):
+        return static_url(url[len(STATIC_PREFIX):])
+    return url
+
+
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and values.get('filename') in manifest:
+        values['filename'] = manifest[values['filename']]
+
+
+def send_static_file(filename):
+    """Flask's static view; fingerprinted files are cached and precompressed."""
+
+    app = current_app
+    if not filename.startswith(DIST_DIR + '/') or filename.endswith(MANIFEST):
+        return app.send_static_file(filename)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = None
+    for encoding, suffix in ENCODINGS:
+        compressed = safe_join(app.static_folder, filename + suffix)
+        if (request.accept_encodings[encoding]
+                and compressed and os.path.exists(compressed)):
+            response = send_from_directory(app.static_folder, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = app.send_static_file(filename)
+
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.headers.pop('Expires', None)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    """Serve fingerprinted static files if `build` has been run."""
+
+    load_manifest(app.static_folder)
+    app.url_defaults(fingerprint_static_urls)
+    app.add_template_filter(asset_url)
+    app.view_functions['static'] = send_static_file
@@ -0,0 +1,242 @@
+"""Endpoint benchmarks for Warbler.
+
+Seeds a scaled dataset with the CSV generator and bulk loader, then drives
+the hot routes through the Flask test client, measuring latency, throughput
+and SQL queries per request.
+
+It fails (exit status 1) when a route issues more queries than its budget
+in QUERY_BUDGETS, or when its median latency or query count regresses past
+the stored baseline. Run it from the project root like:
+
+    python -m benchmarks.bench_endpoints --users 20000 --messages 200000 \\
+        --follows 1000000
+    python -m benchmarks.bench_endpoints --skip-seed --update-baseline
+
+By default it uses the database in BENCH_DATABASE_URL
+(postgresql:///warbler-bench); it drops and recreates every table there.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'generator'))
+
+from app import create_app, CURR_USER_KEY
+from config import Config
+from models import db, User, Message
+import seed
+import create_csvs
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Most SQL statements a single request to each route may issue.
+QUERY_BUDGETS = {
+    'homepage': 3,
+    'users_show': 3,
+    'list_users': 3,
+    'list_users_search': 3,
+    'show_following': 3,
+    'users_followers': 3,
+    'show_user_likes': 3,
+    'like_unlike_message': 2,
+    'api_timeline': 3,
+    'api_user_messages': 2,
+    'api_followers': 2,
+}
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL',
+                                             'postgresql:///warbler-bench')
+    WTF_CSRF_ENABLED = False
+
+
+class QueryCounter:
+    """Counts SQL statements sent to any engine while active."""
+
+    def __init__(self):
+        self.count = 0
+        self.active = False
+        event.listen(Engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active:
+            self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        self.active = True
+        return self
+
+    def __exit__(self, *exc):
+        self.active = False
+
+
+def pick_users():
+    """A typical user to browse as, and the most-followed user to look at."""
+
+    viewer = (User
+              .query
+              .filter(User.following_count > 0)
+              .order_by(func.abs(User.following_count - (db.session
+                                                         .query(func.avg(User.following_count))
+                                                         .as_scalar())))
+              .first())
+    celebrity = User.query.order_by(User.followers_count.desc()).first()
+    return viewer, celebrity
+
+
+def routes(viewer, celebrity, message_id):
+    """(name, method, url) for each benchmarked route."""
+
+    term = celebrity.username[:4]
+    return [
+        ('homepage', 'GET', '/'),
+        ('users_show', 'GET', f'/users/{celebrity.id}'),
+        ('list_users', 'GET', '/users'),
+        ('list_users_search', 'GET', f'/users?q={term}'),
+        ('show_following', 'GET', f'/users/{viewer.id}/following'),
+        ('users_followers', 'GET', f'/users/{celebrity.id}/followers'),
+        ('show_user_likes', 'GET', f'/users/{viewer.id}/likes'),
+        ('like_unlike_message', 'POST', f'/users/add_like/{message_id}'),
+        ('api_timeline', 'GET', '/api/v1/timeline'),
+        ('api_user_messages', 'GET', f'/api/v1/users/{celebrity.id}/messages'),
+        ('api_followers', 'GET', f'/api/v1/users/{celebrity.id}/followers'),
+    ]
+
+
+def measure(client, counter, method, url, iterations, warmup):
+    """Median/p95 latency (ms), requests/sec and max queries for one route."""
+
+    for _ in range(warmup):
+        client.open(url, method=method).close()
+
+    timings = []
+    queries = 0
+    for _ in range(iterations):
+        with counter:
+            start = time.perf_counter()
+            resp = client.open(url, method=method)
+            # Streamed pages render as the body is read.
+            resp.get_data()
+            resp.close()
+            timings.append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{method} {url} returned {resp.status_code}")
+        queries = max(queries, counter.count)
+
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings) * 1000,
+        'p95_ms': timings[int(len(timings) * 0.95) - 1] * 1000,
+        'rps': len(timings) / sum(timings),
+        'queries': queries,
+    }
+
+
+def check(results, baseline, tolerance):
+    """Human-readable failures: budget overruns and regressions."""
+
+    failures = []
+    for name, result in results.items():
+        budget = QUERY_BUDGETS[name]
+        if result['queries'] > budget:
+            failures.append(f"{name}: {result['queries']} queries, budget is {budget}")
+
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result['queries'] > previous['queries']:
+            failures.append(f"{name}: {result['queries']} queries, "
+                            f"baseline was {previous['queries']}")
+        limit = previous['p50_ms'] * (1 + tolerance)
+        if result['p50_ms'] > limit:
+            failures.append(f"{name}: median {result['p50_ms']:.1f}ms, "
+                            f"baseline was {previous['p50_ms']:.1f}ms")
+    return failures
+
+
+def generate_and_load(args):
+    with tempfile.TemporaryDirectory() as data_dir:
+        create_csvs.main([
+            '--users', str(args.users),
+            '--messages', str(args.messages),
+            '--follows', str(args.follows),
+            '--seed', 'benchmarks',
+            '--until', '2026-01-01',
+            '--out-dir', data_dir,
+        ])
+        seed.seed(data_dir, seed.DEFAULT_CHUNK_SIZE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Warbler endpoints.")
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--follows', type=int, default=200000)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed median latency growth over the baseline")
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="reuse the data already in the benchmark database")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="store these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    app = create_app(BenchConfig)
+
+    counter = QueryCounter()
+
+    with app.app_context():
+        if not args.skip_seed:
+            generate_and_load(args)
+        viewer, celebrity = pick_users()
+        message_id = (db.session
+                      .query(Message.id)
+                      .filter(Message.user_id == celebrity.id)
+                      .limit(1)
+                      .scalar())
+        bench_routes = routes(viewer, celebrity, message_id)
+        viewer_id = viewer.id
+
+    results = {}
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer_id
+        for name, method, url in bench_routes:
+            results[name] = measure(client, counter, method, url,
+                                    args.iterations, args.warmup)
+
+    print(f"{'route':<22}{'p50 ms':>9}{'p95 ms':>9}{'req/s':>9}{'queries':>9}")
+    for name, result in results.items():
+        print(f"{name:<22}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}"
+              f"{result['rps']:>9.1f}{result['queries']:>9}")
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    failures = check(results, {} if args.update_baseline else baseline, args.tolerance)
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {BASELINE_PATH}")
+
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
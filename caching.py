@@ -0,0 +1,68 @@
+"""HTTP caching policy.
+
+Public pages (a profile, a message, the user listing) call `validate` with
+the values they are rendered from, such as row versions and counters, before
+doing the expensive part. Those values and who is looking (the navbar shows
+the logged-in user) make up a weak ETag; if the client already has that
+version, the view stops there with a 304 and nothing is rendered.
+
+Every other response that doesn't set its own Cache-Control is marked
+``private, no-cache``: it may be kept by the browser, never by a shared
+cache, and is always checked with the server. Static files keep the headers
+Flask's static file handling gives them.
+"""
+
+import hashlib
+
+from flask import Response, abort, g, request, session
+
+
+def viewer():
+    """What about the current user shows up on every page."""
+
+    user = g.get('user')
+    if not user:
+        return None
+    return (user.id, user.profile_version)
+
+
+def validate(*parts):
+    """Answer 304 Not Modified if the client's copy matches `parts`.
+
+    Otherwise remember the ETag so it is sent with the rendered page.
+    """
+
+    source = repr((viewer(),) + parts).encode('utf-8')
+    g.etag = hashlib.sha1(source).hexdigest()
+
+    # A pending flash message has to be rendered into a fresh page.
+    if '_flashes' in session:
+        return
+
+    if request.if_none_match.contains_weak(g.etag):
+        abort(Response(status=304))
+
+
+def forget_etag():
+    # g can outlive a request when a streamed response keeps its context
+    # pushed (the test client does this), so don't inherit a stale tag.
+    g.pop('etag', None)
+
+
+def set_cache_headers(response):
+    if 'Cache-Control' in response.headers:
+        return response
+
+    etag = g.get('etag')
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag, weak=True)
+        scope = 'private' if g.get('user') else 'public'
+        response.headers['Cache-Control'] = f'{scope}, no-cache'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def init_app(app):
+    app.before_request(forget_etag)
+    app.after_request(set_cache_headers)
@@ -0,0 +1,231 @@
+"""Response compression.
+
+`CompressionMiddleware` compresses text responses with the best encoding
+both sides support: brotli (needs the ``brotli`` package), zstd (needs
+``zstandard``) or gzip. Responses that are already encoded (precompressed
+static files), not text (images, fonts, archives), or smaller than
+``COMPRESSION_MIN_SIZE`` bytes are sent as they are. ``COMPRESSION_LEVELS``
+sets the level per encoding.
+
+Streamed responses stay streamed: once the minimum size is reached, every
+chunk the app yields is compressed and flushed straight through, so the
+browser can start on the page before it is finished. `stream_template`
+renders a template that way; pages that load their data up front can use
+it to send markup as it is rendered.
+"""
+
+import zlib
+
+from flask import (before_render_template, current_app, get_flashed_messages,
+                   stream_with_context, template_rendered, Response)
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+import instrumentation
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_MIN_SIZE = 500
+DEFAULT_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6}
+
+# Jinja output pieces are tiny; send them on in chunks of this many.
+STREAM_BUFFER = 64
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+}
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return (self.compressor.compress(data)
+                + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+def available_encoders():
+    """Encoders in order of preference, leaving out missing libraries."""
+
+    encoders = []
+    if brotli is not None:
+        encoders.append(('br', BrotliEncoder))
+    if zstandard is not None:
+        encoders.append(('zstd', ZstdEncoder))
+    encoders.append(('gzip', GzipEncoder))
+    return encoders
+
+
+def negotiate(accept_encoding):
+    """(name, encoder class) the client prefers, or None."""
+
+    accepted = parse_accept_header(accept_encoding)
+    best, best_quality = None, 0
+    for name, encoder in available_encoders():
+        quality = accepted[name]
+        if quality > best_quality:
+            best, best_quality = (name, encoder), quality
+    return best
+
+
+def compressible(environ, status, headers):
+    if environ['REQUEST_METHOD'] == 'HEAD':
+        return False
+    code = int(status.split(None, 1)[0])
+    if code < 200 or code in (204, 206, 304):
+        return False
+    if 'Content-Encoding' in headers:
+        return False
+    if 'no-transform' in headers.get('Cache-Control', ''):
+        return False
+
+    mimetype = headers.get('Content-Type', '').split(';')[0].strip().lower()
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+def unsupported_write(data):
+    raise RuntimeError("the legacy write() callable is not supported with compression")
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing `app`'s responses; see the module docs."""
+
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        chosen = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if chosen is None:
+            return self.wsgi_app(environ, start_response)
+
+        started = {}
+
+        def capture(status, headers, exc_info=None):
+            started.update(status=status, headers=headers, exc_info=exc_info)
+            return unsupported_write
+
+        app_iter = self.wsgi_app(environ, capture)
+        return self.respond(environ, app_iter, started, start_response, chosen)
+
+    def respond(self, environ, app_iter, started, start_response, chosen):
+        try:
+            chunks = iter(app_iter)
+            buffered = []
+            if not started:
+                # The app starts the response on its first chunk.
+                buffered.append(next(chunks, b''))
+
+            status, headers = started['status'], Headers(started['headers'])
+            if not compressible(environ, status, headers):
+                start_response(status, headers.to_wsgi_list(), started['exc_info'])
+                yield from buffered
+                yield from chunks
+                return
+
+            # Hold back a small response until we know whether it is worth it.
+            min_size = self.config.get('COMPRESSION_MIN_SIZE', DEFAULT_MIN_SIZE)
+            size = sum(len(chunk) for chunk in buffered)
+            while size < min_size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                buffered.append(chunk)
+                size += len(chunk)
+
+            if size < min_size:
+                start_response(status, headers.to_wsgi_list(), started['exc_info'])
+                yield b''.join(buffered)
+                return
+
+            name, encoder_class = chosen
+            levels = self.config.get('COMPRESSION_LEVELS', DEFAULT_LEVELS)
+            encoder = encoder_class(levels.get(name, DEFAULT_LEVELS[name]))
+
+            headers.pop('Content-Length', None)
+            headers['Content-Encoding'] = name
+            vary = headers.get('Vary')
+            headers['Vary'] = f"{vary}, Accept-Encoding" if vary else 'Accept-Encoding'
+            etag = headers.get('ETag')
+            if etag and not etag.startswith('W/'):
+                # The compressed bytes differ, so the tag no longer matches them exactly.
+                headers['ETag'] = f"W/{etag}"
+            start_response(status, headers.to_wsgi_list(), started['exc_info'])
+
+            yield encoder.compress(b''.join(buffered))
+            for chunk in chunks:
+                if chunk:
+                    yield encoder.compress(chunk)
+            yield encoder.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but send the page as it renders.
+
+    (Flask only has its own stream_template from 2.2.)
+    """
+
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+
+    # Flashed messages are removed from the session when read; read them
+    # now, while the session cookie can still be updated.
+    get_flashed_messages()
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        stream = template.stream(context)
+        stream.enable_buffering(STREAM_BUFFER)
+        for chunk in stream:
+            with instrumentation.rendering_paused():
+                yield chunk
+        template_rendered.send(app, template=template, context=context)
+
+    return Response(stream_with_context(generate()))
+
+
+def init_app(app):
+    app.config.setdefault('COMPRESSION_MIN_SIZE', DEFAULT_MIN_SIZE)
+    app.config.setdefault('COMPRESSION_LEVELS', dict(DEFAULT_LEVELS))
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, app.config)
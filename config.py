@@ -0,0 +1,92 @@
+"""Settings for Warbler, read from the environment.
+
+`app.create_app` loads `Config` unless given another class; the
+``WARBLER_CONFIG`` environment variable can name one instead, e.g.
+``config.TestConfig``. Settings other modules own (cache sizes, job
+timings, ...) default in their ``init_app`` and can be set here too.
+"""
+
+import os
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def env_list(name):
+    """Comma-separated environment variable `name` as a list."""
+
+    return [item for item in os.environ.get(name, '').split(',') if item]
+
+
+def env_float(name):
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+def env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def engine_options(uri):
+    """SQLAlchemy engine options for database `uri`.
+
+    Size the pool to the worker's threads; pre-ping and recycle drop
+    connections the database or a proxy in between closed while they sat
+    idle. Pool sizing only applies where the dialect pools with a
+    `QueuePool` (not, say, SQLite).
+    """
+
+    options = {
+        'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+    url = make_url(uri)
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        options.update({
+            'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 5)),
+            'pool_timeout': int(os.environ.get('DATABASE_POOL_TIMEOUT', 10)),
+        })
+    return options
+
+
+class Config:
+    """Development defaults, overridden by environment variables."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///warbler')
+
+    # Comma-separated read replicas of the above; see `replicas`.
+    SQLALCHEMY_REPLICA_URIS = env_list('DATABASE_REPLICA_URLS')
+
+    # Per process, for the primary and each replica.
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'abc12345')
+
+    # bcrypt work factor; keep it low in tests, where hashing speed matters
+    # more than resistance to brute force.
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+    # Opt in to Server-Timing headers with per-request SQL time; log SQL
+    # statements slower than SLOW_QUERY_SECONDS if set.
+    SERVER_TIMING = bool(os.environ.get('SERVER_TIMING'))
+    SLOW_QUERY_SECONDS = env_float('SLOW_QUERY_SECONDS')
+
+    # First worker id server workers lease; by default any free one. See
+    # `snowflake`.
+    SNOWFLAKE_WORKER_ID = env_int('SNOWFLAKE_WORKER_ID')
+
+
+class TestConfig(Config):
+    """For the test suite: its own database, cheap hashes, no CSRF."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL',
+                                             'postgresql:///warbler-test')
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    SQLALCHEMY_REPLICA_URIS = []
+    BCRYPT_LOG_ROUNDS = 4
+    WTF_CSRF_ENABLED = False
@@ -0,0 +1,148 @@
+"""Denormalized counters for Warbler.
+
+``User.messages_count``, ``following_count``, ``followers_count`` and
+``likes_count`` let profile and home pages show totals without loading whole
+relationship collections; ``Message.like_count`` does the same for a
+message's likes. Write paths adjust them with set-based UPDATEs in the same
+transaction as the change they count; `recount` and `recount_likes` repair
+them in bulk.
+
+Updates skip session synchronization, so in-session `User` and `Message`
+objects see the new values after the next commit. Cached user rows are
+dropped.
+"""
+
+from collections import Counter, defaultdict
+
+from sqlalchemy import func
+
+from models import db, User, Message, Follows, Likes
+from user_cache import user_rows
+
+COUNTERS = ('messages', 'following', 'followers', 'likes')
+
+
+def _increments(deltas):
+    """UPDATE values adding each of `deltas` to its counter column."""
+
+    values = {}
+    for name, delta in deltas.items():
+        if name not in COUNTERS:
+            raise ValueError(f"Unknown counter: {name}")
+        column = getattr(User, f"{name}_count")
+        values[column] = column + delta
+    return values
+
+
+def adjust(user_id, **deltas):
+    """Add `deltas` (e.g. ``messages=1``) to `user_id`'s counters."""
+
+    (User
+     .query
+     .filter(User.id == user_id)
+     .update(_increments(deltas), synchronize_session=False))
+    user_rows.invalidate(user_id)
+
+
+def adjust_many(user_ids, **deltas):
+    """Add `deltas` to the counters of every user in `user_ids`.
+
+    `user_ids` may be a list or a subquery selecting user ids.
+    """
+
+    (User
+     .query
+     .filter(User.id.in_(user_ids))
+     .update(_increments(deltas), synchronize_session=False))
+    user_rows.clear()
+
+
+def message_deleted(message):
+    """Adjust counters before `message` is deleted along with its likes."""
+
+    adjust(message.user_id, messages=-1)
+
+    likers = (db.session
+              .query(Likes.user_id)
+              .filter(Likes.message_id == message.id)
+              .subquery())
+    adjust_many(likers, likes=-1)
+
+
+def likes_removed(user_ids):
+    """Take a like off the count of each user in `user_ids`, per appearance.
+
+    For purging the likes on a deleted user's messages; `user_ids` are the
+    likers of the deleted likes.
+    """
+
+    by_loss = defaultdict(list)
+    for user_id, lost in Counter(user_ids).items():
+        by_loss[lost].append(user_id)
+    for lost, ids in by_loss.items():
+        adjust_many(ids, likes=-lost)
+
+
+def unliked(message_ids):
+    """Take one like off each message in `message_ids`.
+
+    For purging a deleted user's likes; liking itself goes through `likes`.
+    """
+
+    (Message
+     .query
+     .filter(Message.id.in_(message_ids))
+     .update({Message.like_count: Message.like_count - 1},
+             synchronize_session=False))
+
+
+def recount(user_ids=None):
+    """Recompute counters from the underlying tables.
+
+    Repairs every user, or only those in `user_ids` if given.
+    """
+
+    counts = {
+        User.messages_count: (db.session
+                              .query(func.count(Message.id))
+                              .filter(Message.user_id == User.id)
+                              .as_scalar()),
+        User.following_count: (db.session
+                               .query(func.count(Follows.user_being_followed_id))
+                               .filter(Follows.user_following_id == User.id)
+                               .as_scalar()),
+        User.followers_count: (db.session
+                               .query(func.count(Follows.user_following_id))
+                               .filter(Follows.user_being_followed_id == User.id)
+                               .as_scalar()),
+        User.likes_count: (db.session
+                           .query(func.count(Likes.message_id))
+                           .filter(Likes.user_id == User.id)
+                           .as_scalar()),
+    }
+
+    query = User.query
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+
+    repaired = query.update(counts, synchronize_session=False)
+    user_rows.clear()
+    return repaired
+
+
+def recount_likes(message_ids=None):
+    """Recompute ``Message.like_count`` from the likes table.
+
+    Repairs every message, or only those in `message_ids` if given.
+    """
+
+    like_count = (db.session
+                  .query(func.count(Likes.user_id))
+                  .filter(Likes.message_id == Message.id)
+                  .as_scalar())
+
+    query = Message.query
+    if message_ids is not None:
+        query = query.filter(Message.id.in_(message_ids))
+
+    return query.update({Message.like_count: like_count}, synchronize_session=False)
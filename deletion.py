@@ -0,0 +1,122 @@
+"""Deleting user accounts.
+
+Deleting a user through the ORM loads every message and like they have
+before removing them row by row, which for a busy account takes seconds and
+holds locks the whole time. So `mark_deleted` only sets ``deleted_at``:
+from then on the account can't log in and isn't shown. It also replaces
+the username and email with placeholders, so they are free to sign up with
+again straight away. The `purge` job it queues then removes the user's rows
+in bounded batches, each its own short transaction that also adjusts the
+counters for the rows it deleted, so an interrupted purge can simply be run
+again, and two runs at once don't count any row twice.
+
+Likes of the user's messages are deleted before the messages, so their
+likers' counts can be adjusted; deleting a batch of messages then cascades,
+in the database, to the timeline entries pointing at them. Whatever is left
+when the user row finally goes is removed by the same cascades.
+"""
+
+import secrets
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+import counters
+import jobs
+import timeline
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from user_cache import user_rows
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+def mark_deleted(user):
+    """Delete `user`'s account now and queue the purge of their rows.
+
+    The caller commits.
+    """
+
+    placeholder = f"deleted-{user.id}-{secrets.token_hex(4)}"
+    user.deleted_at = datetime.utcnow()
+    user.username = placeholder
+    user.email = f"{placeholder}@deleted.invalid"
+    jobs.enqueue('deletion.purge', user_id=user.id)
+
+
+def delete_batches(model, key_columns, condition, batch_size, after_delete=None):
+    """Delete `model` rows matching `condition`, `batch_size` at a time.
+
+    `after_delete`, if given, is called with the keys of each batch's rows
+    that this call deleted, in the same transaction. Keys come from
+    ``DELETE ... RETURNING``, so rows another purge of the same user deleted
+    first are left out, and counters are never adjusted for them twice.
+    Returns the number of rows deleted.
+    """
+
+    table = model.__table__
+    key = key_columns[0] if len(key_columns) == 1 else tuple_(*key_columns)
+    total = 0
+    while True:
+        keys = (db.session
+                .query(*key_columns)
+                .filter(condition)
+                .limit(batch_size)
+                .all())
+        if not keys:
+            return total
+
+        values = [k[0] for k in keys] if len(key_columns) == 1 else [tuple(k) for k in keys]
+        deleted = db.session.execute(table
+                                     .delete()
+                                     .where(key.in_(values))
+                                     .returning(*key_columns)).fetchall()
+        if after_delete is not None and deleted:
+            after_delete(deleted)
+        db.session.commit()
+        total += len(deleted)
+
+
+@jobs.handler('deletion.purge')
+def purge(user_id, batch_size=DEFAULT_BATCH_SIZE):
+    """Remove soft-deleted user `user_id` and everything of theirs."""
+
+    follow_key = [Follows.user_being_followed_id, Follows.user_following_id]
+    like_key = [Likes.user_id, Likes.message_id]
+    authored = (db.session
+                .query(Message.id)
+                .filter(Message.user_id == user_id)
+                .subquery())
+
+    # Likes of their messages go first, by hand rather than by cascade, so
+    # the likers' counts come down by exactly the likes deleted.
+    delete_batches(
+        Likes, like_key, Likes.message_id.in_(authored), batch_size,
+        lambda keys: counters.likes_removed([liker for (liker, _) in keys]))
+    delete_batches(
+        Message, [Message.id], Message.user_id == user_id, batch_size)
+    delete_batches(
+        Likes, like_key, Likes.user_id == user_id, batch_size,
+        lambda keys: counters.unliked([message_id for (_, message_id) in keys]))
+    delete_batches(
+        Follows, follow_key, Follows.user_being_followed_id == user_id, batch_size,
+        lambda keys: counters.adjust_many([follower for (_, follower) in keys],
+                                          following=-1))
+
+    def unfollowed(keys):
+        followed_ids = [followed for (followed, _) in keys]
+        counters.adjust_many(followed_ids, followers=-1)
+        timeline.followers_dropped(followed_ids)
+
+    delete_batches(
+        Follows, follow_key, Follows.user_following_id == user_id, batch_size,
+        unfollowed)
+    delete_batches(
+        TimelineEntry, [TimelineEntry.user_id, TimelineEntry.message_id],
+        TimelineEntry.user_id == user_id, batch_size)
+
+    (User
+     .query
+     .filter(User.id == user_id, User.deleted_at.isnot(None))
+     .delete(synchronize_session=False))
+    db.session.commit()
+    user_rows.invalidate(user_id)
@@ -0,0 +1,131 @@
+"""Cache of rendered message cards.
+
+A message card (author avatar and name, date, text) looks the same to every
+viewer, so it is rendered once and reused by the timeline, profile and likes
+pages. Templates call `message_card(msg)`; anything viewer-specific, like
+the like button, is rendered around the cached markup by the page itself.
+
+Cards are stored by message id together with the author's
+``profile_version``, which `user_edit` bumps on every profile edit; a card
+rendered for an older version is treated as missing. Deleting a message
+drops its card.
+
+Each process keeps an LRU of up to ``FRAGMENT_CACHE_SIZE`` cards. Setting
+``FRAGMENT_CACHE_URL`` to a Redis URL (needs the ``redis`` package) shares
+rendered cards between processes as well, for ``FRAGMENT_CACHE_TTL``
+seconds. Stale local copies are harmless: a deleted message is never listed
+again, and a profile edit changes the version the card is looked up with.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+DEFAULT_SIZE = 10000
+DEFAULT_TTL = 24 * 60 * 60
+
+CARD_TEMPLATE = 'messages/_card.html'
+
+
+class FragmentCache:
+    """Size-bounded LRU of (version, html) by key, optionally shared."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.fragments = OrderedDict()
+        self.backend = None
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', DEFAULT_SIZE)
+        app.config.setdefault('FRAGMENT_CACHE_TTL', DEFAULT_TTL)
+        app.config.setdefault('FRAGMENT_CACHE_URL', None)
+
+        url = app.config['FRAGMENT_CACHE_URL']
+        if url:
+            if redis is None:
+                raise RuntimeError("FRAGMENT_CACHE_URL is set but redis is not installed")
+            self.backend = redis.Redis.from_url(url)
+
+    def get(self, key, version):
+        """Cached html for `key` at `version`, or None."""
+
+        with self.lock:
+            entry = self.fragments.get(key)
+            if entry is not None and entry[0] == version:
+                self.fragments.move_to_end(key)
+                return entry[1]
+
+        if self.backend is None:
+            return None
+
+        stored = self.backend.get(f"{self.prefix}:{key}")
+        if stored is None:
+            return None
+        stored_version, html = stored.decode('utf-8').split('|', 1)
+        if int(stored_version) != version:
+            return None
+        self._remember(key, version, html)
+        return html
+
+    def put(self, key, version, html):
+        self._remember(key, version, html)
+        if self.backend is not None:
+            self.backend.set(f"{self.prefix}:{key}", f"{version}|{html}",
+                             ex=current_app.config['FRAGMENT_CACHE_TTL'])
+
+    def delete(self, key):
+        with self.lock:
+            self.fragments.pop(key, None)
+        if self.backend is not None:
+            self.backend.delete(f"{self.prefix}:{key}")
+
+    def clear(self):
+        with self.lock:
+            self.fragments.clear()
+
+    def _remember(self, key, version, html):
+        size = current_app.config.get('FRAGMENT_CACHE_SIZE', DEFAULT_SIZE)
+        if size <= 0:
+            return
+
+        with self.lock:
+            self.fragments[key] = (version, html)
+            self.fragments.move_to_end(key)
+            while len(self.fragments) > size:
+                self.fragments.popitem(last=False)
+
+
+cards = FragmentCache('card')
+
+
+def message_card(message, author=None):
+    """Rendered card for `message`, from the cache when it is current.
+
+    `author` defaults to ``message.user``; views showing one user's
+    messages can pass that user instead.
+    """
+
+    author = author or message.user
+    html = cards.get(message.id, author.profile_version)
+    if html is None:
+        # Rendered directly rather than with render_template: the card does
+        # not need the request context, and it is rendered inside a page.
+        template = current_app.jinja_env.get_template(CARD_TEMPLATE)
+        html = template.render(message=message, author=author)
+        cards.put(message.id, author.profile_version, html)
+    return Markup(html)
+
+
+def init_app(app):
+    """Configure the card cache and make `message_card` available to templates."""
+
+    cards.init_app(app)
+    app.add_template_global(message_card)
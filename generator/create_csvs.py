@@ -2,19 +2,39 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for benchmarks:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --seed 1 --workers 8 --out-dir /tmp/warbler-data
+
+Rows are generated in fixed-size chunks, each from its own random stream
+derived from --seed, and written in order as they are produced. The same
+arguments therefore give the same files whatever the number of workers, and
+memory use does not grow with the size of the data. Nothing is fetched over
+the network.
+
+Followers follow a power law: a few users are followed by very many, most
+by a handful. Each user follows roughly the same number of others.
+
+The files are in the format seed.py loads. The ones in this directory were
+made with the defaults and ``--until 2026-10-17``.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import io
+import math
+import os
+import random
+import sys
+from datetime import datetime, timezone
+from multiprocessing import Pool
+
+from helpers import get_random_datetime, power_law_index
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
@@ -22,56 +42,277 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+CHUNK_SIZE = 20000
 
-# Generate random profile image URLs to use for users
+# Every generated user can log in with the password "password".
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+HEADER_IMAGE_URLS = [
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+WORDS = """
+    able about account across act action activity actually add address
+    after again against age agent agree ahead air all allow almost alone
+    along already also always amount analysis animal another answer any
+    anyone area argue arm around arrive art article artist ask attack
+    attention audience author away baby back bad bag ball bank bar base
+    beat beautiful become bed before begin behavior behind believe best
+    better between beyond big bill bird bit black blood blue board body
+    book born both box boy break bring brother budget build building
+    business buy call camera campaign capital car card care career carry
+    case catch cause cell center central century certain chair chance
+    change character charge check child choice choose church city civil
+    claim class clear close coach cold collection college color come
+    common community company compare computer concern condition
+    conference consider contain continue control cost could country
+    couple course court cover create crime cultural culture cup current
+    customer cut dark data daughter day dead deal death debate decade
+    decide decision deep defense degree describe design despite detail
+    develop difference difficult dinner direction discover discuss
+    disease doctor dog door down draw dream drive drop drug during each
+    early east easy economic edge education effect effort eight either
+    election else employee end energy enjoy enough enter entire
+    environment evening event ever every evidence exactly example
+    executive exist expect experience expert explain eye face fact
+    factor fail fall family far fast father fear federal feel field
+    fight figure fill film final finally financial find fine finger
+    finish fire firm first fish five floor fly focus follow food foot
+    force foreign forget form former forward four free friend front full
+    fund future game garden gas general generation girl give glass goal
+    good government great green ground group grow growth guess gun guy
+    hair half hand hang happen happy hard head health hear heart heat
+    heavy help here high history hit hold home hope hospital hot hotel
+    hour house huge human hundred idea image imagine impact important
+    improve include increase indeed industry information inside instead
+    interest interview investment issue item itself job join just keep
+    key kid kind kitchen know knowledge land language large last late
+    later laugh lawyer lay lead leader learn least leave left leg legal
+    less letter level life light like likely line list listen little
+    live local long look lose loss lot love low machine magazine main
+    maintain major make manage manager many market marriage material
+    matter maybe mean measure media medical meet meeting member memory
+    mention message method middle might military million mind minute
+    miss mission model modern moment money month more morning most
+    mother mouth move movement movie much music must myself name nation
+    natural nature near nearly necessary need network never news
+    newspaper next nice night none north note nothing notice number
+    occur offer office officer often oil old once only open operation
+    opportunity option order organization other outside over owner page
+    pain painting paper parent part partner party pass past patient
+    pattern pay peace people perform perhaps period person phone
+    physical pick picture piece place plan plant play player point
+    police policy political poor popular population position positive
+    possible power practice prepare present president pressure pretty
+    prevent price private probably problem process produce product
+    program project property protect prove provide public pull purpose
+    push quality question quickly quite race radio raise range rate
+    rather reach read ready real reality realize reason receive recent
+    record red reduce reflect region relate remain remember remove
+    report represent require research resource respond rest result
+    return reveal rich right rise risk road rock role room rule run safe
+    same save say scene school science score sea season seat second
+    section security seek sell send senior sense series serious serve
+    service set seven several shake share shoot short shot shoulder show
+    side sign significant similar simple simply since sing single sister
+    sit site situation six size skill skin small smile social society
+    soldier some someone something sometimes song soon sort sound source
+    south space speak special specific speech spend sport spring staff
+    stage stand standard star start state station stay step still stock
+    stop store story strategy street strong structure student study
+    stuff style subject success suddenly suffer suggest summer support
+    sure surface system table take talk task tax teach teacher team
+    technology television tell ten tend term test thank theory thing
+    think third those though thought thousand threat three through
+    throughout throw thus time today together tonight total tough toward
+    town trade traditional training travel treat treatment tree trial
+    trip trouble true truth try turn type under understand unit until
+    upon usually value various very victim view visit voice vote wait
+    walk wall want watch water way weapon wear week weight well west
+    western whatever whether while white whole wide wife will win wind
+    window wish within without woman wonder word work worker world worry
+    would write writer wrong yard yeah year young yourself
+""".split()
+
+CITIES = """
+    Springfield Riverside Fairview Franklin Greenville Bristol Clinton
+    Georgetown Salem Madison Oakland Arlington Ashland Burlington
+    Dover Hudson Kingston Milton Newport Oxford
+""".split()
+
+
+def sentence(rng, max_length=MAX_WARBLER_LENGTH):
+    """A random sentence-like string of at most `max_length` characters."""
+
+    words = rng.choices(WORDS, k=rng.randint(4, 24))
+    text = ' '.join(words).capitalize() + '.'
+    return text[:max_length]
+
+
+def chunk_rng(seed, kind, index):
+    """Independent, reproducible random stream for one chunk of one file."""
+
+    return random.Random(f"{seed}:{kind}:{index}")
+
+
+def user_rows(rng, start, stop, options):
+    for user_id in range(start + 1, stop + 1):
+        username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}"
+        yield [
+            user_id,
+            f"{username}@example.com",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD_HASH,
+            sentence(rng),
+            rng.choice(HEADER_IMAGE_URLS),
+            rng.choice(CITIES),
+        ]
+
+
+def message_rows(rng, start, stop, options):
+    for _ in range(start, stop):
+        yield [
+            sentence(rng),
+            get_random_datetime(rng=rng, now=options['until']),
+            rng.randint(1, options['users']),
+        ]
+
+
+def popular_user(rng, options):
+    """A user id drawn from the power-law popularity distribution.
+
+    Popularity rank is spread over ids by a fixed stride, so the most
+    followed users are not simply the first ones.
+    """
+
+    users = options['users']
+    rank = power_law_index(rng, users, options['alpha'])
+    return (rank * options['stride']) % users + 1
+
+
+def follow_count(user_id, options):
+    """How many users `user_id` follows; counts add up to --follows."""
+
+    base, extra = divmod(options['follows'], options['users'])
+    return min(base + (user_id <= extra), options['users'] - 1)
+
+
+def follow_rows(rng, start, stop, options):
+    users = options['users']
+    for follower in range(start + 1, stop + 1):
+        wanted = follow_count(follower, options)
+        if wanted * 2 > users:
+            # Dense: rejection sampling would crawl; pick uniformly instead.
+            candidates = [u for u in range(1, users + 1) if u != follower]
+            followed = rng.sample(candidates, wanted)
+        else:
+            followed = set()
+            while len(followed) < wanted:
+                user_id = popular_user(rng, options)
+                if user_id != follower:
+                    followed.add(user_id)
+            followed = sorted(followed)
+        for user_id in followed:
+            yield [user_id, follower]
+
+
+GENERATORS = {
+    'users': user_rows,
+    'messages': message_rows,
+    'follows': follow_rows,
+}
+
+
+def render_chunk(task):
+    """CSV text for rows [start, stop) of `kind`. Runs in worker processes."""
+
+    kind, index, start, stop, options = task
+    rng = chunk_rng(options['seed'], kind, index)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(GENERATORS[kind](rng, start, stop, options))
+    return buffer.getvalue()
+
+
+def write_csv(path, headers, kind, total, options, pool):
+    """Write `total` rows of `kind`, generated chunk by chunk, to `path`."""
+
+    tasks = [(kind, index, start, min(start + CHUNK_SIZE, total), options)
+             for index, start in enumerate(range(0, total, CHUNK_SIZE))]
+    chunks = pool.imap(render_chunk, tasks) if pool else map(render_chunk, tasks)
+
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerow(headers)
+        for chunk in chunks:
+            f.write(chunk)
+
+    print(f"wrote {path}", file=sys.stderr)
+
+
+def coprime_stride(users, seed):
+    """A stride coprime with `users`, so `i * stride % users` is a permutation."""
+
+    rng = random.Random(f"{seed}:stride")
+    while True:
+        stride = rng.randrange(1, max(users, 2))
+        if math.gcd(stride, users) == 1:
+            return stride
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Warbler CSV data.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="total follows; capped at every user following everyone")
+    parser.add_argument('--seed', default='warbler',
+                        help="seed for reproducible output")
+    parser.add_argument('--alpha', type=float, default=1.1,
+                        help="power-law exponent for how followers are spread")
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=datetime.now(timezone.utc).replace(
+                            hour=0, minute=0, second=0, microsecond=0, tzinfo=None),
+                        help="latest message timestamp (default: midnight UTC today); "
+                             "fix it to reproduce files on another day")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes; 1 generates in this process")
+    parser.add_argument('--out-dir', default='generator')
+    args = parser.parse_args(argv)
+
+    options = {
+        'users': args.users,
+        'follows': args.follows,
+        'seed': args.seed,
+        'alpha': args.alpha,
+        'until': args.until,
+        'stride': coprime_stride(args.users, args.seed),
+    }
+
+    files = [
+        ('users.csv', USERS_CSV_HEADERS, 'users', args.users),
+        ('messages.csv', MESSAGES_CSV_HEADERS, 'messages', args.messages),
+        ('follows.csv', FOLLOWS_CSV_HEADERS, 'follows', args.users),
+    ]
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    largest = max(args.users, args.messages)
+    pool = Pool(args.workers) if args.workers > 1 and largest > CHUNK_SIZE else None
+    try:
+        for filename, headers, kind, total in files:
+            write_csv(os.path.join(args.out_dir, filename), headers, kind, total,
+                      options, pool)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    main()
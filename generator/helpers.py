@@ -1,14 +1,34 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
 
+YEAR = timedelta(days=365.25)
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random naive UTC datetime within the `year_gap` years before `now`.
 
-    return datetime.fromtimestamp(random_timestamp)
+    Only offsets from `now` are random, so the result doesn't depend on the
+    local timezone.
+    """
+
+    now = now or datetime.utcnow()
+    span = (YEAR * year_gap).total_seconds()
+
+    return now - timedelta(seconds=rng.uniform(0, span))
+
+
+def power_law_index(rng, n, alpha):
+    """Random index in [0, n), where index i has weight roughly 1 / (i + 1) ** alpha.
+
+    Uses the inverse CDF of a continuous power law, so it needs no table of
+    weights and works for any `n`.
+    """
+
+    u = rng.random()
+    if alpha == 1:
+        x = n ** u
+    else:
+        x = ((n ** (1 - alpha) - 1) * u + 1) ** (1 / (1 - alpha))
+    return min(int(x) - 1, n - 1)
@@ -0,0 +1,60 @@
+"""gunicorn settings for Warbler:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is loaded and warmed up once, in the master, and shared with every
+worker it forks. Each worker then opens its own database pools, takes a
+number no other live worker has (which picks its message id worker id if
+``SNOWFLAKE_WORKER_ID`` is set; see `snowflake`), and logs how long all
+that took.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Keep at or below DATABASE_POOL_SIZE, so no thread waits for a connection.
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+accesslog = '-'
+
+logconfig_dict = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'root': {'level': 'INFO', 'handlers': ['console']},
+    'loggers': {
+        'gunicorn.error': {'level': 'INFO', 'handlers': ['console'], 'propagate': False},
+        'gunicorn.access': {'level': 'INFO', 'handlers': ['console'], 'propagate': False},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'generic'},
+    },
+    'formatters': {
+        'generic': {'format': '%(asctime)s [%(process)d] [%(levelname)s] %(name)s: %(message)s'},
+    },
+}
+
+boot_log = logging.getLogger('warbler.boot')
+
+
+def pre_fork(server, worker):
+    # In the master: the lowest number no live worker is using.
+    taken = {getattr(other, 'number', None) for other in server.WORKERS.values()}
+    worker.number = next(n for n in itertools.count() if n not in taken)
+
+
+def post_fork(server, worker):
+    import warmup
+    import wsgi
+
+    worker.fork_time = time.perf_counter()
+    warmup.after_fork(wsgi.app, worker.number)
+
+
+def post_worker_init(worker):
+    boot_log.info("Worker %d ready in %.1fms", worker.number,
+                  (time.perf_counter() - worker.fork_time) * 1000)
@@ -0,0 +1,249 @@
+"""Per-request SQL instrumentation and a Prometheus /metrics endpoint.
+
+SQLAlchemy engine events time every statement. While a request is being
+handled its statement count, total database time and slowest statement are
+collected on `g.sql_stats`, then, once the response is done (for a streamed
+page, when it has been sent):
+
+- added to per-endpoint histograms served as Prometheus text at /metrics;
+- sent back as a ``Server-Timing`` header if ``SERVER_TIMING`` is set, the
+  start of the slowest statement as its ``db-slowest`` description (not for
+  streamed pages, whose headers are sent before they render);
+- statements slower than ``SLOW_QUERY_SECONDS`` (if set) are logged to the
+  ``warbler.slow_queries`` logger with their bind parameters.
+
+With ``RAISE_ON_LAZY_LOAD`` set (the tests set it), any statement issued
+while a template is rendering raises `LazyLoadDuringRender`: views must load
+everything their templates use up front.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import (Response, before_render_template, current_app, g,
+                   has_request_context, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from passwords import hasher
+
+slow_query_log = logging.getLogger('warbler.slow_queries')
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+# Characters of the slowest statement sent back in Server-Timing.
+SLOWEST_STATEMENT_LENGTH = 100
+
+
+class RequestStats:
+    """SQL activity of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+
+    def slowest_summary(self):
+        """The slowest statement on one line, shortened, safe to quote in a header."""
+
+        summary = ' '.join((self.slowest_statement or '').split())
+        if len(summary) > SLOWEST_STATEMENT_LENGTH:
+            summary = summary[:SLOWEST_STATEMENT_LENGTH - 3] + '...'
+        return (summary
+                .encode('ascii', 'replace').decode('ascii')
+                .replace('\\', '\\\\')
+                .replace('"', '\\"'))
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram, one series per endpoint."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = defaultdict(lambda: [[0] * len(self.buckets), 0, 0.0])
+
+    def observe(self, endpoint, value):
+        with self.lock:
+            counts, _, _ = series = self.series[endpoint]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for endpoint, (counts, count, total) in sorted(self.series.items()):
+                label = f'endpoint="{endpoint}"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label}}} {total}')
+                lines.append(f'{self.name}_count{{{label}}} {count}')
+        return lines
+
+
+request_seconds = Histogram(
+    'warbler_request_duration_seconds', "Time spent handling requests.", DURATION_BUCKETS)
+db_seconds = Histogram(
+    'warbler_request_db_seconds', "Time spent in SQL per request.", DURATION_BUCKETS)
+queries_per_request = Histogram(
+    'warbler_request_queries', "SQL statements issued per request.", QUERY_BUCKETS)
+
+HISTOGRAMS = (request_seconds, db_seconds, queries_per_request)
+
+
+class LazyLoadDuringRender(RuntimeError):
+    """A template issued SQL, e.g. by touching an unloaded relationship."""
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_timer(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('rendering_template'):
+        raise LazyLoadDuringRender(
+            f"{g.rendering_template} issued SQL while rendering: {statement}")
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_timer(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+
+    if not has_request_context():
+        return
+
+    stats = getattr(g, 'sql_stats', None)
+    if stats is not None:
+        stats.record(statement, seconds)
+
+    threshold = current_app.config.get('SLOW_QUERY_SECONDS')
+    if threshold is not None and seconds >= threshold:
+        slow_query_log.warning("%.1fms in %s: %s %r", seconds * 1000,
+                               request.endpoint, statement, parameters)
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_timer(context):
+    # A failed statement never reaches after_cursor_execute.
+    if context.execution_context is None or context.connection is None:
+        return
+    started = context.connection.info.get('query_started')
+    if started:
+        started.pop()
+
+
+@contextmanager
+def rendering_paused():
+    """Don't treat SQL as issued by a template until the block ends.
+
+    For streamed templates, whose rendering is suspended between chunks.
+    If the stream is closed early, rendering is over and stays that way.
+    """
+
+    template_name = g.pop('rendering_template', None)
+    yield
+    if template_name is not None:
+        g.rendering_template = template_name
+
+
+def observe(endpoint, stats):
+    """Add a finished request's `stats` to the histograms. Returns its seconds."""
+
+    elapsed = time.perf_counter() - stats.started
+    request_seconds.observe(endpoint, elapsed)
+    db_seconds.observe(endpoint, stats.db_seconds)
+    queries_per_request.observe(endpoint, stats.queries)
+    return elapsed
+
+
+def init_app(app):
+    """Collect SQL stats for `app`'s requests and serve them at /metrics."""
+
+    app.config.setdefault('SERVER_TIMING', False)
+    app.config.setdefault('SLOW_QUERY_SECONDS', None)
+    app.config.setdefault('RAISE_ON_LAZY_LOAD', False)
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = RequestStats()
+
+    @app.after_request
+    def finish_sql_stats(response):
+        stats = getattr(g, 'sql_stats', None)
+        if stats is None:
+            return response
+
+        endpoint = request.endpoint or 'unmatched'
+        if response.is_streamed:
+            # The page renders, and may query, after this; its headers go
+            # out first, so there is no Server-Timing.
+            response.call_on_close(lambda: observe(endpoint, stats))
+            return response
+
+        elapsed = observe(endpoint, stats)
+        if app.config['SERVER_TIMING']:
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries", '
+                f'db-slowest;dur={stats.slowest_seconds * 1000:.1f};'
+                f'desc="{stats.slowest_summary()}", '
+                f'app;dur={elapsed * 1000:.1f}')
+        return response
+
+    def start_rendering(sender, template, context, **extra):
+        if not sender.config['RAISE_ON_LAZY_LOAD']:
+            return
+        # g.user loads on first use; do that before the template does.
+        bool(g.get('user'))
+        g.rendering_template = template.name
+
+    def finish_rendering(sender, template, context, **extra):
+        g.pop('rendering_template', None)
+
+    before_render_template.connect(start_rendering, app, weak=False)
+    template_rendered.connect(finish_rendering, app, weak=False)
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
+
+
+def metrics():
+    """Request and password hashing metrics in Prometheus text format."""
+
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+
+    stats = hasher.stats()
+    lines.extend([
+        "# HELP warbler_password_hash_queue_depth Password hashes waiting or running.",
+        "# TYPE warbler_password_hash_queue_depth gauge",
+        f"warbler_password_hash_queue_depth {stats['queue_depth']}",
+        "# HELP warbler_password_hash_seconds Time spent hashing and checking passwords.",
+        "# TYPE warbler_password_hash_seconds summary",
+        f"warbler_password_hash_seconds_sum {stats['total_seconds']}",
+        f"warbler_password_hash_seconds_count {stats['completed']}",
+        "# HELP warbler_password_hash_max_seconds Slowest password hash or check.",
+        "# TYPE warbler_password_hash_max_seconds gauge",
+        f"warbler_password_hash_max_seconds {stats['max_seconds']}",
+    ])
+
+    return Response('\n'.join(lines) + '\n',
+                    mimetype='text/plain; version=0.0.4')
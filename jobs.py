@@ -0,0 +1,220 @@
+"""Background jobs, kept in a durable outbox.
+
+`enqueue` adds a row to the ``jobs`` table in the caller's transaction, so
+a job exists exactly when the change that asked for it was committed.
+Workers, started with ``flask jobs work``, claim due jobs with ``SELECT ...
+FOR UPDATE SKIP LOCKED`` and run the function registered for the job's name
+with `handler`. Any number of worker threads and processes can run side by
+side without taking the same job.
+
+A claimed job is leased for ``JOBS_LEASE_SECONDS``. If its worker dies, the
+job is picked up again when the lease runs out. A job that raises is
+retried after ``JOBS_BACKOFF_SECONDS``, doubling each time, until it has
+been tried ``JOBS_MAX_ATTEMPTS`` times; then it is kept with ``failed_at``
+set. Jobs can therefore run more than once, and handlers must allow that.
+
+With ``JOBS_EAGER`` set, `enqueue` runs the job at once instead, in the
+caller's transaction; handy in development, where there may be no worker.
+"""
+
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import func
+
+from models import db, Job
+
+job_log = logging.getLogger('warbler.jobs')
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_BACKOFF_SECONDS = 10
+DEFAULT_MAX_ATTEMPTS = 5
+MAX_BACKOFF_SECONDS = 3600
+
+# Jobs a worker claims at a time.
+CLAIM_BATCH = 10
+
+handlers = {}
+
+
+def handler(name):
+    """Decorator registering a function as the handler for jobs `name`.
+
+    The function is called with the job's payload as keyword arguments, in
+    an app context; the worker commits when it returns.
+    """
+
+    def register(func):
+        handlers[name] = func
+        return func
+
+    return register
+
+
+def enqueue(name, **payload):
+    """Queue job `name`, to be run with `payload` once the caller commits.
+
+    The payload must be JSON-serializable.
+    """
+
+    if name not in handlers:
+        raise ValueError(f"Unknown job: {name}")
+
+    if current_app.config['JOBS_EAGER']:
+        handlers[name](**payload)
+        return None
+
+    job = Job(name=name, payload=payload)
+    db.session.add(job)
+    return job
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed `attempts` times."""
+
+    base = current_app.config['JOBS_BACKOFF_SECONDS']
+    return min(base * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+
+def claim(limit=CLAIM_BATCH):
+    """Lease up to `limit` due jobs to this worker.
+
+    Returns (id, name, payload, attempts) tuples.
+    """
+
+    now = datetime.utcnow()
+    lease = timedelta(seconds=current_app.config['JOBS_LEASE_SECONDS'])
+    jobs = (Job
+            .query
+            .filter(Job.run_at <= now, Job.failed_at.is_(None))
+            .order_by(Job.run_at, Job.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all())
+
+    claimed = []
+    for job in jobs:
+        job.run_at = now + lease
+        job.attempts += 1
+        claimed.append((job.id, job.name, job.payload, job.attempts))
+    db.session.commit()
+    return claimed
+
+
+def run(job_id, name, payload, attempts):
+    """Run one claimed job. Returns whether it succeeded."""
+
+    try:
+        handlers[name](**payload)
+        Job.query.filter(Job.id == job_id).delete(synchronize_session=False)
+        db.session.commit()
+        return True
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        job_log.warning("Job %s (%s) failed on attempt %d:\n%s",
+                        job_id, name, attempts, error)
+
+    now = datetime.utcnow()
+    if attempts >= current_app.config['JOBS_MAX_ATTEMPTS']:
+        values = {Job.failed_at: now, Job.last_error: error}
+    else:
+        values = {Job.run_at: now + timedelta(seconds=backoff(attempts)),
+                  Job.last_error: error}
+    Job.query.filter(Job.id == job_id).update(values, synchronize_session=False)
+    db.session.commit()
+    return False
+
+
+def run_pending():
+    """Run due jobs until there are none left. Returns how many were run."""
+
+    count = 0
+    while True:
+        claimed = claim()
+        if not claimed:
+            return count
+        for job in claimed:
+            run(*job)
+        count += len(claimed)
+
+
+def work(app, threads=1, interval=1.0, burst=False):
+    """Run jobs in `threads` threads, polling every `interval` seconds.
+
+    With `burst`, return once no jobs are due instead of waiting for more.
+    """
+
+    stop = threading.Event()
+
+    def loop():
+        while not stop.is_set():
+            with app.app_context():
+                try:
+                    ran = run_pending()
+                except Exception:
+                    # E.g. the database went away; try again after a pause.
+                    job_log.exception("Could not claim jobs")
+                    ran = 0
+            if not ran:
+                if burst:
+                    return
+                stop.wait(interval)
+
+    workers = [threading.Thread(target=loop, name=f"jobs-{n}", daemon=True)
+               for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(0.5)
+    except KeyboardInterrupt:
+        # Let running jobs finish; unfinished ones are retried after their lease.
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+
+jobs_cli = AppGroup('jobs', help="Run and inspect background jobs.")
+
+
+@jobs_cli.command('work')
+@click.option('--threads', type=int, default=1, help="worker threads in this process")
+@click.option('--interval', type=float, default=1.0, metavar='SECONDS',
+              help="how often to check for new jobs when idle")
+@click.option('--burst', is_flag=True, help="exit once no jobs are due")
+@with_appcontext
+def work_command(threads, interval, burst):
+    """Run background jobs until interrupted."""
+
+    work(current_app._get_current_object(), threads, interval, burst)
+
+
+@jobs_cli.command('status')
+@with_appcontext
+def status_command():
+    """Count queued and failed jobs by name."""
+
+    rows = (db.session
+            .query(Job.name,
+                   func.count(Job.id).filter(Job.failed_at.is_(None)),
+                   func.count(Job.failed_at))
+            .group_by(Job.name)
+            .order_by(Job.name)
+            .all())
+    for name, queued, failed in rows:
+        print(f"{name}: {queued} queued, {failed} failed")
+
+
+def init_app(app):
+    app.config.setdefault('JOBS_EAGER', False)
+    app.config.setdefault('JOBS_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)
+    app.config.setdefault('JOBS_BACKOFF_SECONDS', DEFAULT_BACKOFF_SECONDS)
+    app.config.setdefault('JOBS_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+    app.cli.add_command(jobs_cli)
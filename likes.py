@@ -0,0 +1,67 @@
+"""Liking and unliking messages in a single round trip.
+
+`toggle` flips whether a user likes a message in one statement:
+data-modifying CTEs delete the like if it exists, insert it otherwise, and
+adjust the user's ``likes_count`` and the message's ``like_count`` together.
+
+Only the one like row and the two counter rows are touched, however many
+likes the message has. Concurrent likes of a popular message queue briefly
+on its counter row, never on each other's like rows.
+"""
+
+from sqlalchemy import text
+
+from models import db
+from user_cache import user_rows
+
+TOGGLE = text("""
+    WITH removed AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING message_id
+    ), added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, :message_id
+        WHERE NOT EXISTS (SELECT 1 FROM removed)
+          AND EXISTS (SELECT 1 FROM messages WHERE id = :message_id)
+        ON CONFLICT DO NOTHING
+        RETURNING message_id
+    ), counted AS (
+        UPDATE users
+        SET likes_count = likes_count
+                          + (SELECT count(*) FROM added)
+                          - (SELECT count(*) FROM removed)
+        WHERE id = :user_id
+    ), liked AS (
+        UPDATE messages
+        SET like_count = like_count
+                         + (SELECT count(*) FROM added)
+                         - (SELECT count(*) FROM removed)
+        WHERE id = :message_id
+        RETURNING like_count
+    )
+    SELECT (SELECT count(*) FROM added) AS added,
+           (SELECT count(*) FROM removed) AS removed,
+           (SELECT like_count FROM liked) AS likes
+""")
+
+
+def toggle(user_id, message_id):
+    """Like `message_id` for `user_id` if they haven't yet, else unlike it.
+
+    Returns (liked, like count), or None if there is no such message.
+    The caller commits.
+    """
+
+    params = {'user_id': user_id, 'message_id': message_id}
+    added, removed, likes = db.session.execute(TOGGLE, params).first()
+
+    if likes is None:
+        return None
+
+    if not (added or removed):
+        # A concurrent request from the same user liked it first.
+        return True, likes
+
+    user_rows.invalidate(user_id)
+    return bool(added), likes
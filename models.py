@@ -2,11 +2,13 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, and_, any_, event, literal, or_, text
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from replicas import RoutingSQLAlchemy
+import snowflake
+
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,26 +28,113 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows X"; this serves "whom does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
 
-    id = db.Column(
+    user_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=text("timezone('utc', now())"),
+    )
+
+    # The primary key serves "does X like this"; these serve a user's likes,
+    # newest first, and a message's likers.
+    __table_args__ = (
+        db.Index('ix_likes_user_id_timestamp', 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
+
+class TimelineEntry(db.Model):
+    """A message pushed into a follower's precomputed home timeline.
+
+    Message ids are time-ordered, so the primary key alone serves a
+    timeline newest first.
+    """
+
+    __tablename__ = 'timeline_entries'
+
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+        index=True,
+    )
+
+
+class Job(db.Model):
+    """Background work waiting to be done; see `jobs`."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    # When the job may next be claimed: when it was enqueued, the end of a
+    # worker's lease on it, or when a failed attempt is retried.
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # Set once the job has used up its attempts; it is then left alone.
+    failed_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_due', 'run_at', 'id', postgresql_where=text('failed_at IS NULL')),
     )
 
 
@@ -73,12 +162,12 @@ class User(db.Model):
 
     image_url = db.Column(
         db.Text,
-        default="/static/images/default-pic.png",
+        default='/static/images/default-pic.png',
     )
 
     header_image_url = db.Column(
         db.Text,
-        default="/static/images/warbler-hero.jpg"
+        default='/static/images/warbler-hero.jpg',
     )
 
     bio = db.Column(
@@ -94,7 +183,58 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', cascade = "all,delete")
+    # Denormalized counts, kept up to date by `counters` in the same
+    # transaction as the rows they count.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever the user edits their profile, so anything cached from
+    # it (message cards, page ETags) goes stale.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the user deletes their account. From then on they can't log
+    # in and aren't shown; `deletion.purge` removes their rows later.
+    deleted_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_users_deleted', 'id', postgresql_where=text('deleted_at IS NOT NULL')),
+        # Finds the few authors with too many followers to push to (`timeline`).
+        db.Index('ix_users_followers_count', 'followers_count'),
+    )
+
+    # Deleting through the ORM would load every message first; the
+    # database cascades them instead.
+    messages = db.relationship('Message', cascade = "all,delete", passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -121,17 +261,27 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @property
+    def follow_state(self):
+        """This user's `FollowState`, living as long as the instance does.
+
+        Instances belong to the request's session, so this is per-request.
+        """
+
+        state = self.__dict__.get('_follow_state')
+        if state is None:
+            state = self.__dict__['_follow_state'] = FollowState(self.id)
+        return state
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self.follow_state.is_followed_by(other_user.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return self.follow_state.is_following(other_user.id)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -140,7 +290,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -160,27 +310,129 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
-        If can't find matching user (or if password is wrong), returns False.
+        If can't find matching user (or if password is wrong, or the account
+        was deleted), returns False.
+
+        If the stored hash was made with an outdated work factor, it is
+        replaced with a fresh one; the caller commits.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
 
+def trigram_available(ddl, target, bind, **kw):
+    """Can this Postgres server provide the pg_trgm extension?"""
+
+    return bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar() is not None
+
+
+# Username substring search (see search.py) uses a trigram GIN index where
+# the server supports it; elsewhere search falls back to an in-memory index.
+USERNAME_TRIGRAM_INDEX = DDL(
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm; "
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users "
+    "USING gin (username gin_trgm_ops)"
+).execute_if(dialect='postgresql', callable_=trigram_available)
+
+event.listen(User.__table__, 'after_create', USERNAME_TRIGRAM_INDEX)
+
+
+class FollowState:
+    """A viewer's follow relationships to a batch of other users.
+
+    Call `prime` with every user id a page is about to show; that fetches
+    both directions of the relationship in one query, after which
+    `is_following` / `is_followed_by` are set lookups. Ids that were not
+    primed are fetched on demand.
+    """
+
+    def __init__(self, viewer_id):
+        self.viewer_id = viewer_id
+        self.following = set()
+        self.followers = set()
+        self.resolved = set()
+
+    def prime(self, user_ids):
+        """Load the viewer's relationship to each of `user_ids`."""
+
+        user_ids = set(user_ids) - self.resolved
+        if not user_ids:
+            return
+
+        # One array parameter rather than an IN list of bind parameters:
+        # follower pages prime thousands of ids at once.
+        ids = any_(literal(sorted(user_ids), db.ARRAY(db.Integer)))
+        rows = (db.session
+                .query(Follows.user_being_followed_id, Follows.user_following_id)
+                .filter(or_(
+                    and_(Follows.user_following_id == self.viewer_id,
+                         Follows.user_being_followed_id == ids),
+                    and_(Follows.user_being_followed_id == self.viewer_id,
+                         Follows.user_following_id == ids)))
+                .all())
+
+        for followed_id, follower_id in rows:
+            if follower_id == self.viewer_id:
+                self.following.add(followed_id)
+            if followed_id == self.viewer_id:
+                self.followers.add(follower_id)
+
+        self.resolved |= user_ids
+
+    def is_following(self, user_id):
+        """Does the viewer follow `user_id`?"""
+
+        self.prime([user_id])
+        return user_id in self.following
+
+    def is_followed_by(self, user_id):
+        """Does `user_id` follow the viewer?"""
+
+        self.prime([user_id])
+        return user_id in self.followers
+
+
+@event.listens_for(db.session, 'after_flush')
+def forget_follow_state(session, flush_context):
+    """Drop cached follow states of users whose follows just changed."""
+
+    touched = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Follows):
+            touched.update((obj.user_being_followed_id, obj.user_following_id))
+
+    if not touched:
+        return
+
+    for obj in session.identity_map.values():
+        if isinstance(obj, User) and obj.id in touched:
+            obj.__dict__.pop('_follow_state', None)
+
+
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    Ids are made by `snowflake` and increase with time, so lists of
+    messages sort and page by id.
+    """
 
     __tablename__ = 'messages'
 
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -191,7 +443,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -200,8 +452,22 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # How many users like this message, kept up to date by `likes` and
+    # `counters` like the per-user counts.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    # A user's messages, newest first: profiles, pulled timelines, backfills.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -211,3 +477,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    hasher.init_app(app)
@@ -0,0 +1,77 @@
+"""Keyset (cursor) pagination for Warbler message lists.
+
+Pages are keyed on the sort key of the last row shown, so fetching a deep
+page costs the same index range read as fetching the first one. Message ids
+are time-ordered (see `snowflake`), so most lists key on the id alone; a
+user's likes key on ``(like timestamp, message id)``. The key is handed to
+the browser as an opaque ``?before=`` token.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+# The types of a message list's key.
+ID_KEY = (int,)
+
+
+def encode_cursor(*key):
+    """Make an opaque token for the row with sort key `key`."""
+
+    parts = [value.isoformat() if isinstance(value, datetime) else str(value)
+             for value in key]
+    raw = '|'.join(parts).encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, types=ID_KEY):
+    """Turn a token from `encode_cursor` back into a key of `types`.
+
+    Returns None if the token is malformed.
+    """
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii')
+        parts = raw.split('|')
+        if len(parts) != len(types):
+            return None
+        return tuple(datetime.fromisoformat(part) if kind is datetime else kind(part)
+                     for kind, part in zip(types, parts))
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+
+
+def before(query, cursor, column, tiebreak=None):
+    """Restrict `query` to rows sorting strictly before `cursor`, newest first.
+
+    Rows are sorted on `column`, then `tiebreak` if given; `cursor` holds a
+    value for each.
+    """
+
+    if cursor is None:
+        return query
+
+    if tiebreak is None:
+        (value,) = cursor
+        return query.filter(column < value)
+
+    value, tie = cursor
+    return query.filter(or_(column < value,
+                            and_(column == value, tiebreak < tie)))
+
+
+def next_page(rows, per_page, key=None):
+    """Split `per_page + 1` fetched messages into (page, next token or None).
+
+    `key` gives a row's sort key; by default its ``id``.
+    """
+
+    if len(rows) <= per_page:
+        return rows, None
+
+    page = rows[:per_page]
+    last = page[-1]
+    return page, encode_cursor(*(key(last) if key else (last.id,)))
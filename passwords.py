@@ -0,0 +1,141 @@
+"""Password hashing for Warbler, kept off the request thread.
+
+bcrypt is deliberately slow. Hashes and checks run in a bounded pool of
+worker processes, so they use every core instead of holding the GIL in the
+web worker. At most ``PASSWORD_HASH_QUEUE_LIMIT`` jobs wait at a time;
+further callers block until there is room.
+
+The work factor comes from ``BCRYPT_LOG_ROUNDS``; set it low in tests.
+Hashes made with a different cost are upgraded on the next successful login
+(see `User.authenticate`). Set ``PASSWORD_HASH_WORKERS`` to 0 to hash inline.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app, has_app_context
+
+DEFAULT_LOG_ROUNDS = 12
+
+# bcrypt only looks at the first 72 bytes; older bcrypt releases truncated
+# silently, newer ones refuse longer input.
+MAX_PASSWORD_BYTES = 72
+
+
+def _encode(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(_encode(password), hashed.encode('utf-8'))
+
+
+def hash_cost(hashed):
+    """Work factor a bcrypt hash was made with ('$2b$12$...' -> 12)."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded process pool and records how it is doing."""
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+        self.slots = None
+        self.pending = 0
+        self.completed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def init_app(self, app):
+        # Like `db.app`, used when there is no app context (e.g. in tests).
+        self.app = app
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1))
+        app.config.setdefault('PASSWORD_HASH_QUEUE_LIMIT', 64)
+
+    def _config(self, key, default):
+        app = current_app if has_app_context() else self.app
+        return app.config.get(key, default)
+
+    def _executor(self):
+        """The process pool, started lazily and again after a fork."""
+
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                workers = self._config('PASSWORD_HASH_WORKERS', 1)
+                self.pool = ProcessPoolExecutor(max_workers=workers)
+                self.pool_pid = os.getpid()
+                self.slots = threading.BoundedSemaphore(
+                    self._config('PASSWORD_HASH_QUEUE_LIMIT', 64))
+            return self.pool, self.slots
+
+    def _run(self, fn, *args):
+        start = time.perf_counter()
+        with self.lock:
+            self.pending += 1
+        try:
+            if not self._config('PASSWORD_HASH_WORKERS', 1):
+                return fn(*args)
+
+            pool, slots = self._executor()
+            with slots:
+                return pool.submit(fn, *args).result()
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+
+    @property
+    def rounds(self):
+        return self._config('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured work factor."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than configured?"""
+
+        return hash_cost(hashed) != self.rounds
+
+    def stats(self):
+        """Queue depth and latency figures since the process started.
+
+        Served on /metrics (see `instrumentation`).
+        """
+
+        with self.lock:
+            return {
+                'queue_depth': self.pending,
+                'completed': self.completed,
+                'total_seconds': self.total_seconds,
+                'mean_seconds': (self.total_seconds / self.completed
+                                 if self.completed else 0.0),
+                'max_seconds': self.max_seconds,
+            }
+
+
+hasher = PasswordHasher()
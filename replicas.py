@@ -0,0 +1,142 @@
+"""Sending reads to read replicas.
+
+``SQLALCHEMY_REPLICA_URIS`` lists replica databases; with none, everything
+uses the primary as before. Views decorated with `replica_reads` run their
+GET requests against a randomly picked replica. Replica connections are
+opened read-only, so a write that gets there by mistake fails instead of
+vanishing.
+
+A session switches back to the primary for good as soon as it writes. And
+since replicas lag behind the primary a little, a client whose request
+committed something reads from the primary for the next
+``REPLICA_LAG_WINDOW`` seconds, so it sees its own changes.
+
+To try it locally, point ``SQLALCHEMY_REPLICA_URIS`` at a streaming
+replica of the development database, or at the database itself under a
+second URI; the routing is the same.
+"""
+
+import random
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+DEFAULT_LAG_WINDOW = 5
+
+# Session key: when this client last committed a write (epoch seconds).
+WROTE_AT_KEY = '_wrote_at'
+
+READ_ONLY = '-c default_transaction_read_only=on'
+
+
+class ReplicaEngines:
+    """Engines for the configured replicas, created on first use."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engines = {}
+
+    def for_app(self, app):
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+        with self.lock:
+            for uri in uris:
+                if uri not in self.engines:
+                    self.engines[uri] = self.create(app, uri)
+            return [self.engines[uri] for uri in uris]
+
+    def create(self, app, uri):
+        options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        connect_args = dict(options.get('connect_args', {}))
+        connect_args['options'] = f"{connect_args.get('options', '')} {READ_ONLY}".strip()
+        options['connect_args'] = connect_args
+        return create_engine(uri, **options)
+
+    def dispose(self):
+        """Close every pooled replica connection, e.g. after a fork."""
+
+        with self.lock:
+            for engine in self.engines.values():
+                engine.dispose()
+
+
+replica_engines = ReplicaEngines()
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from a replica once `use_replica` has been called."""
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.replica = None
+
+    def use_replica(self):
+        """Send reads to a replica, if any are configured."""
+
+        engines = replica_engines.for_app(self.app)
+        if engines:
+            self.replica = random.choice(engines)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica is not None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                # Writing; this and everything after it goes to the primary.
+                self.replica = None
+            else:
+                return self.replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with a `RoutingSession`."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def note_write(db_session):
+    if has_request_context():
+        g.committed = True
+
+
+def recently_wrote():
+    """Did this client commit a write within the replica lag window?"""
+
+    window = current_app.config['REPLICA_LAG_WINDOW']
+    return session.get(WROTE_AT_KEY, 0) > time.time() - window
+
+
+def replica_reads(view):
+    """Decorator: run `view`'s GET requests against a replica."""
+
+    @wraps(view)
+    def read_from_replica(*args, **kwargs):
+        if request.method in ('GET', 'HEAD') and not recently_wrote():
+            current_app.extensions['sqlalchemy'].db.session().use_replica()
+        return view(*args, **kwargs)
+
+    return read_from_replica
+
+
+def use_primary():
+    # The session can outlive a request when a streamed response keeps its
+    # context pushed (the test client does this); start each on the primary.
+    current_app.extensions['sqlalchemy'].db.session().replica = None
+
+
+def remember_write(response):
+    if g.pop('committed', False):
+        session[WROTE_AT_KEY] = time.time()
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+    app.config.setdefault('REPLICA_LAG_WINDOW', DEFAULT_LAG_WINDOW)
+    app.before_request(use_primary)
+    app.after_request(remember_write)
@@ -0,0 +1,221 @@
+"""Username substring search for Warbler.
+
+On Postgres with the pg_trgm extension, ``ILIKE '%q%'`` is answered from a
+trigram GIN index on ``users.username`` (see models.py). Without pg_trgm,
+an in-process n-gram index narrows the candidates instead of scanning every
+username. Each search first adds users who signed up since the last one, by
+id; renames and deletions made by other processes are picked up by a full
+reload every ``SEARCH_INDEX_RELOAD_SECONDS``.
+
+Either way results are ranked: usernames starting with the query first,
+then by how early the match occurs, then shorter usernames first.
+"""
+
+import time
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import case, event, func, text
+
+from models import db, User
+
+NGRAM_SIZE = 3
+DEFAULT_RELOAD_SECONDS = 300
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in `term` (using backslash as escape char)."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def rank_key(username, term):
+    """Sort key putting prefix matches first, then earlier, shorter matches."""
+
+    folded = username.lower()
+    position = folded.find(term)
+    return (position != 0, position, len(username), folded)
+
+
+class NgramIndex:
+    """In-memory n-gram index of usernames.
+
+    Maps every 1- to `NGRAM_SIZE`-character substring of each lowercased
+    username to the ids of users containing it. A query intersects the
+    posting sets of its own n-grams and verifies the survivors.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.postings = {}
+        self.usernames = {}
+        self.loaded = False
+        self.loaded_at = 0.0
+        self.last_id = 0
+
+    @staticmethod
+    def grams(term):
+        """Every substring of `term` up to `NGRAM_SIZE` characters long."""
+
+        return {term[i:i + n]
+                for n in range(1, NGRAM_SIZE + 1)
+                for i in range(len(term) - n + 1)}
+
+    def load(self):
+        """Bring the index up to date with the users table.
+
+        Rebuilds it if it is empty or older than
+        ``SEARCH_INDEX_RELOAD_SECONDS``; otherwise only adds users with ids
+        above the last one seen.
+        """
+
+        reload_seconds = current_app.config.get('SEARCH_INDEX_RELOAD_SECONDS',
+                                                DEFAULT_RELOAD_SECONDS)
+        with self.lock:
+            now = time.monotonic()
+            if not self.loaded or now - self.loaded_at >= reload_seconds:
+                self._clear()
+                self.loaded = True
+                self.loaded_at = now
+            for user_id, username in (db.session
+                                      .query(User.id, User.username)
+                                      .filter(User.id > self.last_id,
+                                              User.deleted_at.is_(None))):
+                self._remove(user_id)
+                self._add(user_id, username)
+                self.last_id = max(self.last_id, user_id)
+
+    def invalidate(self):
+        """Forget everything; the next search reloads from the database."""
+
+        with self.lock:
+            self._clear()
+            self.loaded = False
+
+    def _clear(self):
+        self.postings.clear()
+        self.usernames.clear()
+        self.last_id = 0
+
+    def _add(self, user_id, username):
+        self.usernames[user_id] = username.lower()
+        for gram in self.grams(username.lower()):
+            self.postings.setdefault(gram, set()).add(user_id)
+
+    def _remove(self, user_id):
+        username = self.usernames.pop(user_id, None)
+        if username is None:
+            return
+        for gram in self.grams(username):
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(user_id)
+
+    def put(self, user_id, username):
+        """Index (or re-index) `user_id` under `username`."""
+
+        with self.lock:
+            if self.loaded:
+                self._remove(user_id)
+                self._add(user_id, username)
+
+    def discard(self, user_id):
+        """Drop `user_id` from the index."""
+
+        with self.lock:
+            if self.loaded:
+                self._remove(user_id)
+
+    def search(self, term):
+        """Ids of users whose username contains `term`, best match first."""
+
+        self.load()
+        term = term.lower()
+        # Searching with the longest grams gives the smallest posting sets.
+        size = min(len(term), NGRAM_SIZE)
+        query_grams = {term[i:i + size] for i in range(len(term) - size + 1)}
+
+        with self.lock:
+            postings = sorted((self.postings.get(gram, set()) for gram in query_grams),
+                              key=len)
+            candidates = set.intersection(*postings) if postings else set()
+            matches = [(rank_key(self.usernames[user_id], term), user_id)
+                       for user_id in candidates
+                       if term in self.usernames[user_id]]
+
+        return [user_id for _, user_id in sorted(matches)]
+
+
+username_index = NgramIndex()
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def index_username(mapper, connection, user):
+    username_index.put(user.id, user.username)
+
+
+@event.listens_for(User, 'after_delete')
+def unindex_username(mapper, connection, user):
+    username_index.discard(user.id)
+
+
+_trigram_support = {}
+
+
+def has_trigram_index():
+    """Is the database Postgres with pg_trgm installed?"""
+
+    engine = db.get_engine()
+    if engine.url not in _trigram_support:
+        supported = False
+        if engine.dialect.name == 'postgresql':
+            supported = db.session.execute(text(
+                "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() is not None
+        _trigram_support[engine.url] = supported
+    return _trigram_support[engine.url]
+
+
+def search_users(term, page=1, per_page=50):
+    """Users whose username contains `term`, ranked, for `page` (1-based).
+
+    Returns (users, has_more).
+    """
+
+    offset = (page - 1) * per_page
+
+    if has_trigram_index():
+        folded = term.lower()
+        pattern = escape_like(folded)
+        users = (User
+                 .query
+                 .filter(User.username.ilike(f"%{pattern}%", escape='\\'),
+                         User.deleted_at.is_(None))
+                 .order_by(case([(User.username.ilike(f"{pattern}%", escape='\\'), 0)],
+                                else_=1),
+                           func.strpos(func.lower(User.username), folded),
+                           func.length(User.username),
+                           User.username)
+                 .offset(offset)
+                 .limit(per_page + 1)
+                 .all())
+        return users[:per_page], len(users) > per_page
+
+    ids = username_index.search(term)
+    page_ids = ids[offset:offset + per_page]
+    if not page_ids:
+        return [], False
+
+    # Re-check against the database: the index may lag behind other processes.
+    folded = term.lower()
+    found = {user.id: user
+             for user in (User
+                          .query
+                          .filter(User.id.in_(page_ids), User.deleted_at.is_(None))
+                          .all())
+             if folded in user.username.lower()}
+    users = [found[user_id] for user_id in page_ids if user_id in found]
+    return users, len(ids) > offset + per_page
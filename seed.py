@@ -1,20 +1,256 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Recreates the tables, then streams users.csv, messages.csv and follows.csv
+into them in chunks, so files of any size load in bounded memory. On
+Postgres each chunk goes through ``COPY ... FROM STDIN``; elsewhere it is a
+batched executemany. Messages are given time-ordered ids from their
+timestamps (see `snowflake`). Secondary indexes and foreign keys are added
+after the data is in, sequences are moved past the loaded ids, and counters
+and home timelines are rebuilt. Home timelines are much the largest table,
+so its keys are added only once it is filled.
 
+Run it like:
 
-db.drop_all()
-db.create_all()
+    python seed.py --data-dir generator --chunk-size 50000
+"""
 
-# with open('generator/users.csv') as users:
-#     db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from datetime import datetime
+from itertools import islice
 
-# with open('generator/messages.csv') as messages:
-#     db.session.bulk_insert_mappings(Message, DictReader(messages))
+from sqlalchemy import DDL, inspect, text
+from sqlalchemy.schema import AddConstraint
 
-# with open('generator/follows.csv') as follows:
-#     db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from app import create_app
+from models import db, User, Message, Follows, TimelineEntry, USERNAME_TRIGRAM_INDEX
+import counters
+import snowflake
+import timeline
 
-db.session.commit()
+# Loaded in this order, so foreign keys are satisfied once they are added.
+TABLES = [
+    ('users.csv', User.__table__),
+    ('messages.csv', Message.__table__),
+    ('follows.csv', Follows.__table__),
+]
+
+# Filled by `timeline.rebuild` after the load, with even its primary key
+# deferred until then.
+REBUILT_TABLES = [TimelineEntry.__table__]
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def read_chunks(path, chunk_size):
+    """Yield (header, rows) for each chunk of at most `chunk_size` rows."""
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                return
+            yield header, rows
+
+
+def with_message_ids(header, rows, loaded):
+    """Add an ``id`` made from its timestamp to each message row.
+
+    The low bits of each id count rows across the load, so messages with
+    the same timestamp still get distinct ids.
+    """
+
+    low_bits = (1 << snowflake.TIME_SHIFT) - 1
+    timestamp = header.index('timestamp')
+    rows = [row + [snowflake.id_for(datetime.fromisoformat(row[timestamp]),
+                                    (loaded + n) & low_bits)]
+            for n, row in enumerate(rows)]
+    return header + ['id'], rows
+
+
+def converters(table, header):
+    """Functions turning CSV strings into values for each of `header`'s columns."""
+
+    def convert(column):
+        python_type = column.type.python_type
+
+        def to_value(raw):
+            if raw == '' and column.nullable:
+                return None
+            if python_type is datetime:
+                return datetime.fromisoformat(raw)
+            return python_type(raw)
+
+        return to_value
+
+    return [convert(table.c[name]) for name in header]
+
+
+def copy_chunk(connection, table, header, rows):
+    """Load `rows` with Postgres COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    columns = ', '.join(header)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_chunk(connection, table, header, rows):
+    """Load `rows` with one executemany INSERT."""
+
+    convert = converters(table, header)
+    connection.execute(table.insert(), [
+        {name: to_value(raw) for name, to_value, raw in zip(header, convert, row)}
+        for row in rows
+    ])
+
+
+def load_table(engine, table, path, chunk_size):
+    """Stream the CSV at `path` into `table`. Returns the number of rows."""
+
+    loaded = 0
+    start = time.perf_counter()
+
+    def chunks():
+        for header, rows in read_chunks(path, chunk_size):
+            if table is Message.__table__ and 'id' not in header:
+                header, rows = with_message_ids(header, rows, loaded)
+            yield header, rows
+
+    if engine.dialect.name == 'postgresql':
+        connection = engine.raw_connection()
+        try:
+            for header, rows in chunks():
+                copy_chunk(connection, table, header, rows)
+                loaded += len(rows)
+                report(table.name, loaded, start, done=False)
+            connection.commit()
+        finally:
+            connection.close()
+    else:
+        with engine.begin() as connection:
+            for header, rows in chunks():
+                insert_chunk(connection, table, header, rows)
+                loaded += len(rows)
+                report(table.name, loaded, start, done=False)
+
+    report(table.name, loaded, start, done=True)
+    return loaded
+
+
+def report(name, rows, start, done):
+    elapsed = time.perf_counter() - start
+    rate = rows / elapsed if elapsed else 0
+    end = '\n' if done else '\r'
+    print(f"{name}: {rows:,} rows in {elapsed:.1f}s ({rate:,.0f} rows/sec)",
+          end=end, file=sys.stderr, flush=True)
+
+
+def drop_deferred(engine):
+    """Drop secondary indexes and foreign keys before loading (Postgres only).
+
+    Returns what `restore_deferred` needs to put them back.
+    """
+
+    indexes = [index for table in db.metadata.sorted_tables for index in table.indexes]
+    constraints = [fk for table in db.metadata.sorted_tables
+                   for fk in table.foreign_key_constraints]
+    constraints += [table.primary_key for table in REBUILT_TABLES]
+
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        connection.execute(DDL("DROP INDEX IF EXISTS ix_users_username_trgm"))
+        for index in indexes:
+            index.drop(bind=connection)
+        for table in db.metadata.sorted_tables:
+            for fk in inspector.get_foreign_keys(table.name):
+                connection.execute(DDL(
+                    f'ALTER TABLE {table.name} DROP CONSTRAINT "{fk["name"]}"'))
+        for table in REBUILT_TABLES:
+            name = inspector.get_pk_constraint(table.name)['name']
+            connection.execute(DDL(f'ALTER TABLE {table.name} DROP CONSTRAINT "{name}"'))
+
+    return indexes, constraints
+
+
+def restore_deferred(engine, indexes, constraints, tables):
+    """Recreate what `drop_deferred` dropped on `tables`, now they are filled."""
+
+    with engine.begin() as connection:
+        for index in indexes:
+            if index.table in tables:
+                index.create(bind=connection)
+        if User.__table__ in tables:
+            USERNAME_TRIGRAM_INDEX.execute(bind=connection, target=User.__table__)
+        for constraint in constraints:
+            if constraint.table in tables:
+                connection.execute(AddConstraint(constraint))
+        for table in tables:
+            connection.execute(text(f"ANALYZE {table.name}"))
+
+
+def reset_sequences(engine):
+    """Move each serial id sequence past the largest loaded id (Postgres only)."""
+
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if 'id' not in table.c or not table.c.id.autoincrement:
+                continue
+            connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}"))
+
+
+def seed(data_dir, chunk_size):
+    engine = db.engine
+    postgres = engine.dialect.name == 'postgresql'
+
+    db.drop_all()
+    db.create_all()
+
+    if postgres:
+        deferred = drop_deferred(engine)
+
+    start = time.perf_counter()
+    total = sum(load_table(engine, table, os.path.join(data_dir, filename), chunk_size)
+                for filename, table in TABLES)
+
+    if postgres:
+        loaded = [table for table in db.metadata.sorted_tables
+                  if table not in REBUILT_TABLES]
+        restore_deferred(engine, *deferred, loaded)
+        reset_sequences(engine)
+    report('all tables', total, start, done=True)
+
+    counters.recount()
+    timeline.rebuild()
+    db.session.commit()
+    if postgres:
+        restore_deferred(engine, *deferred, REBUILT_TABLES)
+    report('total, with counters and timelines', total, start, done=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory holding users.csv, messages.csv and follows.csv")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows loaded per COPY or executemany batch")
+    args = parser.parse_args(argv)
+
+    with create_app().app_context():
+        seed(args.data_dir, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Time-ordered 64-bit message ids, made in the app.
+
+An id packs the milliseconds since `EPOCH`, the id of the worker that made
+it, and a per-millisecond sequence number:
+
+    | 41 bits: milliseconds | 10 bits: worker | 12 bits: sequence |
+
+So ids sort in the order they were made, across workers to within clock
+skew, and message lists can sort and page on the primary key alone. Each
+process making ids needs a worker id (0-1023) no other live process has,
+or two of them can make the same id in the same millisecond. Processes
+lease one from the database: the worker id is held as a Postgres advisory
+lock, on a connection of its own, for as long as the process lives.
+
+A process leases any free worker id when it makes its first id. Server
+workers can ask for a particular one instead: given ``SNOWFLAKE_WORKER_ID``,
+the server's worker processes number themselves from it (see
+gunicorn.conf.py), and one that finds its id taken fails as it starts.
+
+The clock never runs backwards here: if the system clock does, or a
+worker uses up a millisecond's 4096 sequence numbers, ids carry on from
+the last millisecond used.
+"""
+
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+# 2010-01-01 UTC, in milliseconds. 41 bits of milliseconds last until 2079.
+EPOCH = 1262304000000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+# First key of the advisory locks worker ids are leased with ('snow').
+LEASE_NAMESPACE = 0x736e6f77
+
+
+def millis(timestamp):
+    """Milliseconds since the Unix epoch of naive UTC datetime `timestamp`."""
+
+    return int(timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def make_id(ms, worker_id=0, sequence=0):
+    """The id for millisecond `ms` (since the Unix epoch), worker and sequence."""
+
+    return ((ms - EPOCH) << TIME_SHIFT) | (worker_id << SEQUENCE_BITS) | sequence
+
+
+def id_for(timestamp, low_bits=0):
+    """An id for naive UTC datetime `timestamp`, for loading existing rows.
+
+    `low_bits` (below 2**22) fill the worker and sequence fields; rows with
+    the same timestamp need different ones.
+    """
+
+    return make_id(millis(timestamp)) | low_bits
+
+
+def timestamp_of(snowflake_id):
+    """The naive UTC datetime at which `snowflake_id` was made."""
+
+    ms = (snowflake_id >> TIME_SHIFT) + EPOCH
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).replace(tzinfo=None)
+
+
+class IdGenerator:
+    """Makes unique, increasing ids for one worker. Thread-safe.
+
+    It can't make ids until it has a worker id.
+    """
+
+    def __init__(self, worker_id=None):
+        self.lock = threading.Lock()
+        self.set_worker(worker_id)
+
+    def set_worker(self, worker_id):
+        if worker_id is not None and not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"Worker id must be between 0 and {MAX_WORKER_ID}")
+        with self.lock:
+            self.worker_id = worker_id
+            self.last_ms = 0
+            self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            if self.worker_id is None:
+                raise RuntimeError("No worker id to make ids with")
+            ms = max(int(time.time() * 1000), self.last_ms)
+            if ms == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    ms += 1
+            else:
+                self.sequence = 0
+            self.last_ms = ms
+            return make_id(ms, self.worker_id, self.sequence)
+
+
+class WorkerLease:
+    """A worker id held by this process, as a Postgres advisory lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.database_uri = None
+        self.connection = None
+        self.worker_id = None
+
+    def acquire(self, wanted=None):
+        """Lease worker id `wanted`, or else any free one. Returns it.
+
+        Raises RuntimeError if `wanted` is taken, or every id is.
+        """
+
+        with self.lock:
+            if self.worker_id is not None and wanted in (None, self.worker_id):
+                return self.worker_id
+            self.release()
+
+            engine = create_engine(self.database_uri, poolclass=NullPool)
+            connection = engine.connect()
+            candidates = range(MAX_WORKER_ID + 1) if wanted is None else [wanted]
+            for worker_id in candidates:
+                if connection.execute(text("SELECT pg_try_advisory_lock(:namespace, :id)"),
+                                      namespace=LEASE_NAMESPACE, id=worker_id).scalar():
+                    self.connection = connection
+                    self.worker_id = worker_id
+                    return worker_id
+            connection.close()
+
+        if wanted is None:
+            raise RuntimeError("Every snowflake worker id is taken")
+        raise RuntimeError(f"Snowflake worker id {wanted} is taken")
+
+    def release(self):
+        """Give up the worker id, if held. Call with `lock` held."""
+
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.worker_id = None
+
+
+ids = IdGenerator()
+lease = WorkerLease()
+leasing = threading.Lock()
+
+
+def next_id():
+    """A new id from this process's generator."""
+
+    if ids.worker_id is None:
+        with leasing:
+            if ids.worker_id is None:
+                ids.set_worker(lease.acquire())
+    return ids.next_id()
+
+
+def init_app(app, worker_number=None):
+    """Set up leasing worker ids from `app`'s database.
+
+    Forked server workers call this again with their `worker_number`. With
+    ``SNOWFLAKE_WORKER_ID`` set, they lease that plus their number at once;
+    other processes lease any free worker id when they first need one.
+    """
+
+    lease.database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    base = app.config.get('SNOWFLAKE_WORKER_ID')
+    if base is None or worker_number is None:
+        ids.set_worker(lease.worker_id)
+    else:
+        ids.set_worker(lease.acquire(int(base) + worker_number))
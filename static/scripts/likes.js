@@ -0,0 +1,13 @@
+// Toggle likes through the JSON API so the timeline updates in place
+// instead of reloading. Without JavaScript the form posts as before.
+$(document).on('submit', 'form.like-form', function (evt) {
+  evt.preventDefault();
+  var $form = $(this);
+
+  $.post($form.data('api')).done(function (data) {
+    $form.find('button')
+      .toggleClass('btn-primary', data.liked)
+      .toggleClass('btn-secondary', !data.liked)
+      .find('.like-count').text(data.likes);
+  });
+});
@@ -7,24 +7,19 @@
 
 import os
 from unittest import TestCase
-from app import app
+from app import create_app
+from config import TestConfig
 from datetime import datetime
 
 from sqlalchemy.exc import IntegrityError
 
 from models import db, User, Message, Follows
+import snowflake
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
-app.config['SQLALCHEMY_ECHO'] = False
-
-
-# Now we can import app
+# Build an app with the test settings: its own database, cheap password
+# hashes and no CSRF (see config.TestConfig).
 
+app = create_app(TestConfig)
 
 
 # Create our tables (we do this here, so we only create the tables
@@ -66,6 +61,44 @@ class MessageModelTestCase(TestCase):
             db.session.commit()
             self.assertEqual(m.user.username,'user1')
             
+    def test_message_ids_and_timestamps(self):
+        """Each message gets its own timestamp and a larger id than the last."""
+        user1 = User.query.filter(User.username =='user1').one()
+        first = Message(text="first", user_id=user1.id)
+        db.session.add(first)
+        db.session.commit()
+        second = Message(text="second", user_id=user1.id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertGreater(second.timestamp, first.timestamp)
+        self.assertLess(abs(snowflake.timestamp_of(first.id) - first.timestamp).total_seconds(), 1)
+
+    def test_snowflake_ids(self):
+        """Ids made faster than the clock ticks stay unique and increasing."""
+        ids = snowflake.IdGenerator(worker_id=7)
+        made = [ids.next_id() for _ in range(10000)]
+
+        self.assertEqual(made, sorted(set(made)))
+        self.assertEqual((made[0] >> snowflake.SEQUENCE_BITS) & snowflake.MAX_WORKER_ID, 7)
+        with self.assertRaises(ValueError):
+            snowflake.IdGenerator(worker_id=snowflake.MAX_WORKER_ID + 1)
+
+    def test_worker_leases(self):
+        """Processes lease different worker ids, and can't take one in use."""
+        leases = [snowflake.WorkerLease(), snowflake.WorkerLease()]
+        for lease in leases:
+            lease.database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+            self.addCleanup(lease.release)
+        first = leases[0].acquire()
+        second = leases[1].acquire()
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(leases[0].acquire(), first)
+        with self.assertRaises(RuntimeError):
+            leases[1].acquire(first)
+
     def test_invalid_message_model(self):
         """testing user_id left blank"""
         with self.assertRaises(IntegrityError):
@@ -7,20 +7,23 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User, Likes
+from models import db, connect_db, Message, User, Likes, Follows, Job
+import fragments
+import jobs
+import search
+import snowflake
+import warmup
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+from app import create_app, CURR_USER_KEY
+from config import TestConfig
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# Build an app with the test settings: its own database, cheap password
+# hashes and no CSRF (see config.TestConfig).
 
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
+app = create_app(TestConfig)
+app.config['RAISE_ON_LAZY_LOAD'] = True
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -28,9 +31,6 @@ from app import app, CURR_USER_KEY
 
 db.create_all()
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
 
 
 class MessageViewTestCase(TestCase):
@@ -41,6 +41,7 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        Job.query.delete()
 
         self.client = app.test_client()
 
@@ -101,12 +102,16 @@ class MessageViewTestCase(TestCase):
 
             new_msg_resp = c.post("/messages/new", data={"text": "Hello"})
             msg = Message.query.one()
+            msg_id = msg.id
+            c.get(f"/users/{self.testuser.id}")
+            self.assertIsNotNone(fragments.cards.get(msg_id, 0))
             resp = c.post(f"/messages/{msg.id}/delete")
             msg_check = Message.query.all()
             
 
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(msg_check, [])
+            self.assertIsNone(fragments.cards.get(msg_id, 0))
     
     def test_add_message_when_logged_out(self):
         """Are we rightly prohibited from adding a message when logged out?"""
@@ -158,6 +163,71 @@ class MessageViewTestCase(TestCase):
             self.assertIn('unliked', unlike_html)
             self.assertEqual(all_likes, [])
     
+    def test_api_like_message(self):
+        """The JSON like endpoint toggles the like and reports the new state."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post("/messages/new", data={"text": "Like this!"})
+            msg = Message.query.one()
+            like_resp = c.post(f"/api/messages/{msg.id}/like")
+            unlike_resp = c.post(f"/api/messages/{msg.id}/like")
+            missing_resp = c.post(f"/api/messages/{msg.id + 1}/like")
+            user = User.query.get(self.testuser.id)
+
+            self.assertEqual(like_resp.get_json(), {"message_id": str(msg.id), "liked": True, "likes": 1})
+            self.assertEqual(unlike_resp.get_json(), {"message_id": str(msg.id), "liked": False, "likes": 0})
+            self.assertEqual(missing_resp.status_code, 404)
+            self.assertEqual(user.likes_count, 0)
+            self.assertEqual(Likes.query.all(), [])
+
+    def test_many_likers(self):
+        """Any number of users can like a message; it counts them."""
+        liker = User.signup(username="liker", email="liker@test.com",
+                            password="liker", image_url=None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=self.testuser.id, user_following_id=liker.id))
+        db.session.commit()
+        liker_id, testuser_id = liker.id, self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post("/messages/new", data={"text": "Like this!"})
+            msg_id = Message.query.one().id
+            jobs.run_pending()
+            own_resp = c.post(f"/api/messages/{msg_id}/like")
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+            like_resp = c.post(f"/api/messages/{msg_id}/like")
+            home = c.get("/").data.decode("utf-8")
+
+            self.assertEqual(own_resp.get_json()["likes"], 1)
+            self.assertEqual(like_resp.get_json(), {"message_id": str(msg_id), "liked": True, "likes": 2})
+            self.assertEqual(Likes.query.filter_by(message_id=msg_id).count(), 2)
+            self.assertEqual(Message.query.get(msg_id).like_count, 2)
+            self.assertIn('<span class="like-count">2</span>', home)
+
+    def test_warm_up(self):
+        """Warming up renders recent cards; a forked worker gets its own id range."""
+        db.session.add(Message(text="Warm me", user_id=self.testuser.id))
+        db.session.commit()
+        msg_id = Message.query.one().id
+        fragments.cards.clear()
+
+        # Tests bulk-delete users behind the search index's back.
+        self.addCleanup(search.username_index.invalidate)
+        timings = warmup.warm(app)
+        with app.app_context():
+            cached = fragments.cards.get(msg_id, 0)
+        with patch.dict(app.config, {'SNOWFLAKE_WORKER_ID': 40}):
+            warmup.after_fork(app, worker_number=2)
+        worker_id = snowflake.ids.worker_id
+        snowflake.init_app(app)
+
+        self.assertEqual(set(timings), {'templates', 'mappers', 'search index', 'cards'})
+        self.assertIn("Warm me", cached)
+        self.assertEqual(worker_id, 42)
+
     def test_like_message_logged_out(self):
         """Tests of the like_unlike view function while logged out - it should not allow us to like."""
         with self.client as c:
@@ -0,0 +1,211 @@
+"""Query plan tests.
+
+Each test runs a hot page or query against a seeded dataset, records the SQL
+it sends, and EXPLAINs every statement. Sequential scans, sorts, and joins
+other than nested loops are disabled for the EXPLAIN, so the planner only
+scans or sorts a table when no index can do the job; the test then fails,
+naming the statement. So does reading a whole index without a condition
+(the planner's other way around a missing index), unless a LIMIT stops it
+early.
+"""
+
+from unittest import TestCase
+
+from sqlalchemy import event, text
+
+from app import create_app, CURR_USER_KEY
+from config import TestConfig
+from models import db, User, Message, Follows, Likes, Job, TimelineEntry
+from passwords import hasher
+import counters
+import jobs
+import snowflake
+import timeline
+
+app = create_app(TestConfig)
+
+db.create_all()
+
+USERS = 500
+MESSAGES_PER_USER = 20
+FOLLOWS_PER_USER = 10
+LIKERS_PER_MESSAGE = 3
+
+SEED = [
+    """INSERT INTO users (email, username, password)
+       SELECT 'user' || n || '@example.com', 'user' || n, :password
+       FROM generate_series(1, :users) AS n""",
+    # Ids as `snowflake.id_for` makes them, numbering rows in the low bits.
+    """INSERT INTO messages (id, text, timestamp, user_id)
+       SELECT ((floor(extract(epoch FROM stamp) * 1000)::bigint - :epoch) << :time_shift)
+              | row_number() OVER (),
+              'warble ' || n, stamp, user_id
+       FROM (SELECT timezone('utc', now()) - n * interval '1 minute' AS stamp,
+                    n, users.id AS user_id
+             FROM users, generate_series(1, :messages_per_user) AS n) AS new""",
+    # Each user follows the next FOLLOWS_PER_USER users by id, wrapping around.
+    """INSERT INTO follows (user_being_followed_id, user_following_id)
+       SELECT followed.id, follower.id
+       FROM users AS follower
+       JOIN users AS followed
+         ON followed.id <> follower.id
+        AND (followed.id - follower.id + :users) % :users <= :follows_per_user""",
+    # Every third message is liked by the next few users after its author.
+    """INSERT INTO likes (user_id, message_id, timestamp)
+       SELECT liker.id, messages.id, messages.timestamp + n * interval '1 second'
+       FROM messages
+       CROSS JOIN generate_series(1, :likers_per_message) AS n
+       JOIN users AS liker
+         ON liker.id = (SELECT min(id) FROM users)
+                       + (messages.user_id - (SELECT min(id) FROM users) + n) % :users
+       WHERE messages.id % 3 = 0""",
+]
+
+# Plan nodes that mean an index was missing.
+UNINDEXED = {'Seq Scan', 'Sort'}
+
+INDEX_SCANS = {'Index Scan', 'Index Only Scan', 'Bitmap Index Scan'}
+
+# With these off the planner uses an index wherever there is one, whatever
+# it thinks of the seeded tables' sizes. (Hash and merge joins would read
+# the inner table whole even if it could be looked up.)
+PLANNER_OFF = ['enable_seqscan', 'enable_sort', 'enable_hashjoin', 'enable_mergejoin']
+
+
+def seed():
+    Likes.query.delete()
+    Follows.query.delete()
+    TimelineEntry.query.delete()
+    Message.query.delete()
+    User.query.delete()
+    Job.query.delete()
+
+    params = {'users': USERS,
+              'messages_per_user': MESSAGES_PER_USER,
+              'follows_per_user': FOLLOWS_PER_USER,
+              'likers_per_message': LIKERS_PER_MESSAGE,
+              'password': hasher.hash('password'),
+              'epoch': snowflake.EPOCH,
+              'time_shift': snowflake.TIME_SHIFT}
+    for statement in SEED:
+        db.session.execute(text(statement), params)
+    counters.recount()
+    counters.recount_likes()
+    timeline.rebuild()
+    db.session.commit()
+
+    with db.get_engine(app).begin() as connection:
+        connection.execute(text("ANALYZE"))
+
+
+def unindexed_nodes(plan, limited=False):
+    """Descriptions of the scans and sorts in a JSON `plan` tree that an
+    index should have avoided."""
+
+    node = plan['Node Type']
+    found = []
+    if node in UNINDEXED:
+        found.append(f"{node} {plan.get('Relation Name') or plan.get('Sort Key')}")
+    elif node in INDEX_SCANS and 'Index Cond' not in plan and not limited:
+        found.append(f"Full {node} {plan['Index Name']}")
+
+    limited = node == 'Limit' or (limited and node != 'Aggregate')
+    for child in plan.get('Plans', []):
+        found.extend(unindexed_nodes(child, limited))
+    return found
+
+
+class QueryPlanTestCase(TestCase):
+    """Hot queries are served by indexes."""
+
+    @classmethod
+    def setUpClass(cls):
+        with app.app_context():
+            seed()
+            cls.viewer_id = (db.session
+                             .query(User.id)
+                             .filter(User.username == 'user1')
+                             .scalar())
+            cls.message_id = (db.session
+                              .query(Message.id)
+                              .filter(Message.user_id == cls.viewer_id)
+                              .limit(1)
+                              .scalar())
+
+    def setUp(self):
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def capture(self, action):
+        """The (statement, parameters) pairs `action` sends to the database."""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.get_engine(app), 'before_cursor_execute', record)
+        try:
+            action()
+        finally:
+            event.remove(db.get_engine(app), 'before_cursor_execute', record)
+        return statements
+
+    def assert_indexed(self, statements):
+        self.assertTrue(statements)
+        connection = db.get_engine(app).raw_connection()
+        try:
+            cursor = connection.cursor()
+            for setting in PLANNER_OFF:
+                cursor.execute(f"SET {setting} = off")
+            for statement, parameters in statements:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+                [[[plan]]] = cursor.fetchall()
+                with self.subTest(statement=statement):
+                    self.assertEqual(unindexed_nodes(plan['Plan']), [])
+        finally:
+            connection.rollback()
+            connection.close()
+
+    def assert_page_indexed(self, url):
+        def get():
+            resp = self.client.get(url)
+            resp.get_data()
+            self.assertEqual(resp.status_code, 200)
+
+        self.assert_indexed(self.capture(get))
+
+    def test_homepage(self):
+        self.assert_page_indexed('/')
+
+    def test_user_show(self):
+        self.assert_page_indexed(f'/users/{self.viewer_id}')
+
+    def test_list_users(self):
+        self.assert_page_indexed('/users')
+
+    def test_following_and_followers(self):
+        self.assert_page_indexed(f'/users/{self.viewer_id}/following')
+        self.assert_page_indexed(f'/users/{self.viewer_id}/followers')
+
+    def test_likes(self):
+        self.assert_page_indexed(f'/users/{self.viewer_id}/likes')
+
+    def test_message_show(self):
+        self.assert_page_indexed(f'/messages/{self.message_id}')
+
+    def test_api(self):
+        self.assert_page_indexed('/api/v1/timeline')
+        self.assert_page_indexed(f'/api/v1/users/{self.viewer_id}/messages')
+        self.assert_page_indexed(f'/api/v1/users/{self.viewer_id}/likes')
+        self.assert_page_indexed(f'/api/v1/users/{self.viewer_id}/following')
+        self.assert_page_indexed(f'/api/v1/users/{self.viewer_id}/followers')
+
+    def test_login(self):
+        with app.app_context():
+            self.assert_indexed(self.capture(lambda: User.authenticate('user1', 'password')))
+
+    def test_claim_jobs(self):
+        with app.app_context():
+            self.assert_indexed(self.capture(jobs.claim))
@@ -7,21 +7,16 @@
 
 import os
 from unittest import TestCase
-from app import app
+from app import create_app
+from config import TestConfig
 
 from models import db, User, Message, Follows
+from passwords import hash_cost
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
-app.config['SQLALCHEMY_ECHO'] = False
-
-
-# Now we can import app
+# Build an app with the test settings: its own database, cheap password
+# hashes and no CSRF (see config.TestConfig).
 
+app = create_app(TestConfig)
 
 
 # Create our tables (we do this here, so we only create the tables
@@ -133,14 +128,18 @@ class UserModelTestCase(TestCase):
             user1_auth = user1.authenticate(username = 'userx', password = 'user1password')
             self.assertEqual(user1_auth,False)
 
-
-
-        
-
-
-
-
-
-
-
-
+    def test_rehash_on_login(self):
+        """A successful login upgrades a hash made with an outdated work factor."""
+        with app.test_client() as client:
+            user1 = User.query.filter(User.username =='user1').one()
+            old_cost = hash_cost(user1.password)
+            app.config['BCRYPT_LOG_ROUNDS'] = 5
+            try:
+                with app.app_context():
+                    user1_auth = User.authenticate(username = 'user1', password = 'user1password')
+            finally:
+                app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+            self.assertEqual(old_cost, 4)
+            self.assertEqual(hash_cost(user1_auth.password), 5)
+            self.assertNotEqual(User.authenticate(username = 'user1', password = 'user1password'), False)
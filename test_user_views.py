@@ -1,23 +1,33 @@
 """User views tests."""
 
 
+import gzip
 import os
+import shutil
+import tempfile
+from datetime import timedelta
 from unittest import TestCase
-from app import app, CURR_USER_KEY
+from unittest.mock import patch
+from app import create_app, CURR_USER_KEY
+from config import TestConfig, engine_options
 from flask import url_for
-from models import db, User, Message, Follows
+from sqlalchemy import event, text
+from sqlalchemy.exc import InternalError, ProgrammingError
+from models import db, User, Message, Follows, Likes, Job, TimelineEntry
+import assets
+import counters
+import deletion
+import instrumentation
+import jobs
+import replicas
+import search
+from user_cache import user_rows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler-test"
-app.config['SQLALCHEMY_ECHO'] = False
-
-
-# Now we can import app
+# Build an app with the test settings: its own database, cheap password
+# hashes and no CSRF (see config.TestConfig).
 
+app = create_app(TestConfig)
+app.config['RAISE_ON_LAZY_LOAD'] = True
 
 
 # Create our tables (we do this here, so we only create the tables
@@ -36,6 +46,7 @@ class UserViewTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
         Follows.query.delete()
+        Job.query.delete()
         self.client = app.test_client()
         self.testuser = User.signup(email = 'user1@gmail.com', username = 'user1', image_url = '/static/images/default-pic.png', password = 'user1password')
         db.session.commit()
@@ -55,12 +66,60 @@ class UserViewTestCase(TestCase):
             "username": "user1",
             "image_url": "/static/images/default-pic.png",
             "password": "user1password",
-            "bio": "successfully edited"})
+            "bio": "successfully edited"}, follow_redirects = True)
             html = resp.data.decode("utf-8")
             # import pdb; pdb.set_trace()
             self.assertEqual(resp.status_code, 200)
             self.assertIn("successfully edited", html)
 
+    def test_user_edit_with_stale_cached_user(self):
+        """An edit changes the profile's ETag even if this worker's cached
+        row of the user is behind the database."""
+        testuser_id = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.get('/')
+            self.assertIsNotNone(user_rows.get(testuser_id))
+            # Another worker's write, which this worker's cache doesn't see.
+            db.session.execute(text(
+                "UPDATE users SET profile_version = 1, image_url = '/elsewhere.png' "
+                "WHERE id = :id"), {'id': testuser_id})
+            db.session.commit()
+            etag = c.get(f'/users/{testuser_id}').headers['ETag']
+
+            c.post(f"/users/{testuser_id}/edit", data={"email" : "user1@gmail.com",
+            "username": "user1",
+            "image_url": "/static/images/default-pic.png",
+            "password": "user1password",
+            "bio": "edited again"})
+            after = c.get(f'/users/{testuser_id}', headers={'If-None-Match': etag})
+
+            self.assertEqual(after.status_code, 200)
+            self.assertIn("edited again", after.data.decode("utf-8"))
+            self.assertEqual(User.query.get(testuser_id).profile_version, 2)
+
+    def test_user_edit_after_rename_elsewhere(self):
+        """Editing checks the password against the user's current username,
+        not one from this worker's cache."""
+        testuser_id = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.get('/')
+            db.session.execute(text("UPDATE users SET username = 'renamed' WHERE id = :id"),
+                               {'id': testuser_id})
+            db.session.commit()
+
+            resp = c.post(f"/users/{testuser_id}/edit", data={"email" : "user1@gmail.com",
+            "username": "renamed",
+            "image_url": "/static/images/default-pic.png",
+            "password": "user1password",
+            "bio": "edited after rename"}, follow_redirects=True)
+
+            self.assertNotIn("Access unauthorized", resp.data.decode("utf-8"))
+            self.assertEqual(User.query.get(testuser_id).bio, "edited after rename")
+
     def test_user_edit_logged_out(self):
         with self.client as c:
             resp = c.post(f"/users/{self.testuser.id}/edit", data={"email" : "user1@gmail.com",
@@ -73,6 +132,26 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized", html)
 
+    def test_message_card_after_profile_edit(self):
+        """Cached message cards pick up a new username."""
+        testuser_id = self.testuser.id
+        db.session.add(Message(text = 'card text', user_id = testuser_id))
+        db.session.commit()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            before = c.get(f'/users/{testuser_id}').data.decode("utf-8")
+            c.post(f"/users/{testuser_id}/edit", data={"email" : "user1@gmail.com",
+            "username": "renamed",
+            "image_url": "/static/images/default-pic.png",
+            "password": "user1password"})
+            after = c.get(f'/users/{testuser_id}').data.decode("utf-8")
+
+            self.assertIn('@user1', before)
+            self.assertIn('card text', after)
+            self.assertIn('@renamed', after)
+            self.assertNotIn('@user1', after)
+
     def test_list_users(self):
         with self.client as c:
             resp = c.get('/users')
@@ -81,6 +160,72 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("user1", html)
 
+    def test_list_users_follow_state(self):
+        """The listing shows Unfollow for followed users and Follow for the rest."""
+        testuser_id = self.testuser.id
+        user2_id = User.query.filter(User.username =='user2').one().id
+        db.session.add(Follows(user_being_followed_id = user2_id, user_following_id = testuser_id))
+        db.session.commit()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            html = c.get('/users').data.decode("utf-8")
+
+            self.assertIn(f'action="/users/stop-following/{user2_id}"', html)
+            self.assertIn(f'action="/users/follow/{testuser_id}"', html)
+
+    def test_show_likes(self):
+        """Liked messages render with their authors loaded up front."""
+        testuser_id = self.testuser.id
+        user2_id = User.query.filter(User.username =='user2').one().id
+        msg = Message(text = 'liked by user1', user_id = user2_id)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Likes(user_id = testuser_id, message_id = msg.id))
+        db.session.commit()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            resp = c.get(f'/users/{testuser_id}/likes')
+            html = resp.data.decode("utf-8")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('liked by user1', html)
+            self.assertIn('@user2', html)
+
+    def test_list_users_search(self):
+        """Search matches substrings, case-insensitively, with prefix matches first."""
+        User.signup(email = 'superuser@gmail.com', username = 'SuperUser', image_url = None, password = 'superpassword')
+        db.session.commit()
+        with self.client as c:
+            html = c.get('/users?q=USER').data.decode("utf-8")
+            no_match_html = c.get('/users?q=nobody').data.decode("utf-8")
+
+            self.assertIn("@SuperUser", html)
+            self.assertLess(html.index("@user1"), html.index("@SuperUser"))
+            self.assertIn("Sorry, no users found", no_match_html)
+
+    def test_search_sees_other_writers(self):
+        """The in-process index picks up users added or renamed elsewhere."""
+        self.addCleanup(search.username_index.invalidate)
+        with app.app_context():
+            if search.has_trigram_index():
+                self.skipTest("search uses pg_trgm, not the in-process index")
+            search.search_users('user')
+            db.session.execute(text(
+                "INSERT INTO users (email, username, password) "
+                "VALUES ('alicia@gmail.com', 'alicia', 'x')"))
+            db.session.execute(text("UPDATE users SET username = 'alice' WHERE id = :id"),
+                               {'id': self.testuser.id})
+            db.session.commit()
+
+            added, _ = search.search_users('ali')
+            with patch.dict(app.config, {'SEARCH_INDEX_RELOAD_SECONDS': 0}):
+                reloaded, _ = search.search_users('ali')
+
+        self.assertEqual([user.username for user in added], ['alicia'])
+        self.assertEqual([user.username for user in reloaded], ['alice', 'alicia'])
+
     def test_user_show(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -135,18 +280,459 @@ class UserViewTestCase(TestCase):
             self.assertEqual(unfollow_resp.status_code, 200)
             self.assertEqual(len(total_follows), 0)
     
+    def test_homepage_timeline(self):
+        """Messages from followed users show up on the homepage, pushed or pulled."""
+        user2 = User.query.filter(User.username =='user2').one()
+        user2_id = user2.id
+        testuser_id = self.testuser.id
+        early = Message(text="posted before the follow", user_id = user2_id)
+        db.session.add(early)
+        db.session.commit()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post(f'/users/follow/{user2_id}')
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+            c.post('/messages/new', data={"text": "posted after the follow"})
+            jobs.run_pending()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            html = c.get('/').data.decode("utf-8")
+            app.config['TIMELINE_FANOUT_LIMIT'] = 0
+            pulled_html = c.get('/').data.decode("utf-8")
+            del app.config['TIMELINE_FANOUT_LIMIT']
+
+            self.assertIn("posted before the follow", html)
+            self.assertIn("posted after the follow", html)
+            self.assertIn("posted before the follow", pulled_html)
+            self.assertIn("posted after the follow", pulled_html)
+
+    def test_author_pushed_again(self):
+        """Messages posted while an author was pulled reach their followers'
+        timelines once the author drops back to the fan-out limit."""
+        user2_id = User.query.filter(User.username =='user2').one().id
+        testuser_id = self.testuser.id
+        user3 = User.signup(email = 'user3@gmail.com', username = 'user3', image_url = None, password = 'user3password')
+        db.session.commit()
+        user3_id = user3.id
+        with self.client as c, patch.dict(app.config, {'TIMELINE_FANOUT_LIMIT': 1}):
+            for follower_id in [testuser_id, user3_id]:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+                c.post(f'/users/follow/{user2_id}')
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+            c.post('/messages/new', data={"text": "posted while pulled"})
+            jobs.run_pending()
+            pushed_while_pulled = TimelineEntry.query.count()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user3_id
+            c.post(f'/users/stop-following/{user2_id}')
+            jobs.run_pending()
+
+            self.assertEqual(pushed_while_pulled, 0)
+            self.assertEqual([entry.user_id for entry in TimelineEntry.query.all()],
+                             [testuser_id])
+
+    def test_api(self):
+        """The JSON API pages through timelines, messages, likes and followers."""
+        user2_id = User.query.filter(User.username =='user2').one().id
+        testuser_id = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post(f'/users/follow/{user2_id}')
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+            c.post('/messages/new', data={"text": "first"})
+            c.post('/messages/new', data={"text": "second"})
+            jobs.run_pending()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            page1 = c.get('/api/v1/timeline?limit=1').get_json()
+            page2 = c.get(f"/api/v1/timeline?limit=1&before={page1['next']}").get_json()
+            with patch.dict(app.config, {'TIMELINE_FANOUT_LIMIT': 0}):
+                pulled = c.get('/api/v1/timeline').get_json()
+            messages = c.get(f'/api/v1/users/{user2_id}/messages').get_json()
+            second_id, first_id = [m['id'] for m in messages['data']]
+            c.post(f'/api/messages/{second_id}/like')
+            c.post(f'/api/messages/{first_id}/like')
+            likes1 = c.get(f'/api/v1/users/{testuser_id}/likes?limit=1').get_json()
+            likes2 = c.get(f"/api/v1/users/{testuser_id}/likes?limit=1&before={likes1['next']}").get_json()
+            followers = c.get(f'/api/v1/users/{user2_id}/followers').get_json()
+            found = c.get('/api/v1/users/search?q=user').get_json()
+            missing = c.get(f'/api/v1/users/{user2_id + 100}/following')
+            bad_cursor = c.get('/api/v1/timeline?before=nonsense')
+
+            self.assertEqual([m['text'] for m in page1['data']], ['second'])
+            self.assertEqual(page1['data'][0]['user'],
+                             {'id': user2_id, 'username': 'user2', 'image_url': '/static/images/default-pic.png'})
+            self.assertEqual([m['text'] for m in page2['data']], ['first'])
+            self.assertIsNone(page2['next'])
+            self.assertEqual([m['text'] for m in pulled['data']], ['second', 'first'])
+            self.assertEqual([m['text'] for m in messages['data']], ['second', 'first'])
+            self.assertEqual([m['likes'] for m in messages['data']], [0, 0])
+            # Most recently liked first, each with its new like count.
+            self.assertEqual([(m['text'], m['likes']) for m in likes1['data']], [('first', 1)])
+            self.assertEqual([(m['text'], m['likes']) for m in likes2['data']], [('second', 1)])
+            self.assertIsNone(likes2['next'])
+            self.assertEqual(followers, {'data': [{'id': testuser_id, 'username': 'user1', 'image_url': '/static/images/default-pic.png'}], 'next': None})
+            self.assertEqual(len(found['data']), 2)
+            self.assertEqual(missing.status_code, 404)
+            self.assertEqual(missing.get_json(), {'error': 'No such user'})
+            self.assertEqual(bad_cursor.status_code, 400)
+
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+            self.assertEqual(c.get('/api/v1/timeline').status_code, 401)
+
+    def test_api_logged_out(self):
+        """Who follows whom is for logged-in users, as on the site; likes are public."""
+        testuser_id = self.testuser.id
+        with self.client as c:
+            for path in ['following', 'followers']:
+                with self.subTest(path=path):
+                    resp = c.get(f'/api/v1/users/{testuser_id}/{path}')
+                    self.assertEqual(resp.status_code, 401)
+                    self.assertIn('error', resp.get_json())
+            likes = c.get(f'/api/v1/users/{testuser_id}/likes')
+            likes_page = c.get(f'/users/{testuser_id}/likes')
+
+        self.assertEqual(likes.status_code, 200)
+        self.assertEqual(likes_page.status_code, 200)
+
+    def test_user_show_pagination(self):
+        """Older profile messages are reachable through the `before` cursor."""
+        testuser_id = self.testuser.id
+        for text in ["first warble", "second warble", "third warble"]:
+            db.session.add(Message(text=text, user_id = testuser_id))
+        db.session.commit()
+        with self.client as c, patch('app.MESSAGES_PER_PAGE', 2):
+            first_page = c.get(f"/users/{testuser_id}").data.decode("utf-8")
+            token = first_page.split("before=")[1].split('"')[0]
+            second_page = c.get(f"/users/{testuser_id}?before={token}").data.decode("utf-8")
+            bad_cursor_resp = c.get(f"/users/{testuser_id}?before=not-a-cursor")
+
+            self.assertIn("third warble", first_page)
+            self.assertIn("second warble", first_page)
+            self.assertNotIn("first warble", first_page)
+            self.assertIn("first warble", second_page)
+            self.assertNotIn("second warble", second_page)
+            self.assertNotIn("before=", second_page)
+            self.assertEqual(bad_cursor_resp.status_code, 400)
+
+    def test_counters(self):
+        """Counters follow messages, follows and likes, and recount agrees with them."""
+        testuser_id = self.testuser.id
+        user2_id = User.query.filter(User.username =='user2').one().id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post(f'/users/follow/{user2_id}')
+            c.post('/messages/new', data={"text": "count me"})
+            c.post('/messages/new', data={"text": "count me too"})
+            msg = Message.query.filter(Message.text == "count me").one()
+            c.post(f'/users/add_like/{msg.id}')
+            c.post(f'/messages/{msg.id}/delete')
+            profile_html = c.get(f'/users/{testuser_id}').data.decode("utf-8")
+
+        testuser = User.query.get(testuser_id)
+        user2 = User.query.get(user2_id)
+        counted = (testuser.messages_count, testuser.following_count,
+                   testuser.likes_count, user2.followers_count)
+        counters.recount()
+        db.session.commit()
+        testuser = User.query.get(testuser_id)
+        user2 = User.query.get(user2_id)
+        recounted = (testuser.messages_count, testuser.following_count,
+                     testuser.likes_count, user2.followers_count)
+
+        self.assertEqual(counted, (1, 1, 0, 1))
+        self.assertEqual(recounted, counted)
+        self.assertIn(f'<a href="/users/{testuser_id}/following">1</a>', profile_html)
+
+    def test_session_for_missing_user(self):
+        """A session pointing at a user who no longer exists is treated as logged out."""
+        testuser_id = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.get('/')
+            User.query.filter(User.id == testuser_id).delete()
+            db.session.commit()
+            html = c.get('/').data.decode("utf-8")
+
+            self.assertIn('Sign up', html)
+
+    def test_server_timing_and_metrics(self):
+        """Requests report their SQL time when asked, and feed /metrics."""
+        app.config['SERVER_TIMING'] = True
+        try:
+            with self.client as c:
+                resp = c.get(f'/api/v1/users/{self.testuser.id}/messages')
+                shown = lambda: instrumentation.queries_per_request.series['views.users_show'][1]
+                streamed = c.get(f'/users/{self.testuser.id}')
+                before_close = shown()
+                streamed.close()
+                after_close = shown()
+                metrics = c.get('/metrics').data.decode("utf-8")
+        finally:
+            app.config['SERVER_TIMING'] = False
+
+        # A streamed page's headers go out before it renders.
+        self.assertNotIn('Server-Timing', streamed.headers)
+        self.assertEqual(after_close, before_close + 1)
+        self.assertIn('db;dur=', resp.headers['Server-Timing'])
+        self.assertIn('db-slowest;dur=', resp.headers['Server-Timing'])
+        self.assertIn('desc="SELECT ', resp.headers['Server-Timing'])
+        self.assertIn('warbler_request_queries_count{endpoint="views.users_show"}', metrics)
+        self.assertIn('warbler_password_hash_queue_depth', metrics)
+
+    def test_failed_statement_timing(self):
+        """A statement that fails doesn't leave its start time behind."""
+        with db.get_engine(app).connect() as connection:
+            with self.assertRaises(ProgrammingError):
+                connection.execute(text("SELECT no_such_column FROM users"))
+            self.assertEqual(connection.info['query_started'], [])
+
+    def test_conditional_get(self):
+        """Public pages answer 304 until what they show changes."""
+        testuser_id = self.testuser.id
+        with self.client as c:
+            first = c.get(f'/users/{testuser_id}')
+            etag = first.headers['ETag']
+            repeat = c.get(f'/users/{testuser_id}', headers={'If-None-Match': etag})
+            db.session.add(Message(text = 'something new', user_id = testuser_id))
+            db.session.commit()
+            changed = c.get(f'/users/{testuser_id}', headers={'If-None-Match': etag})
+
+            self.assertEqual(first.headers['Cache-Control'], 'public, no-cache')
+            self.assertEqual(repeat.status_code, 304)
+            self.assertEqual(repeat.data, b'')
+            self.assertEqual(changed.status_code, 200)
+            self.assertIn('something new', changed.data.decode("utf-8"))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            logged_in = c.get(f'/users/{testuser_id}', headers={'If-None-Match': etag})
+            home = c.get('/')
+
+            self.assertEqual(logged_in.status_code, 200)
+            self.assertEqual(logged_in.headers['Cache-Control'], 'private, no-cache')
+            self.assertEqual(home.headers['Cache-Control'], 'private, no-cache')
+            self.assertNotIn('ETag', home.headers)
+
+    def test_fingerprinted_static_files(self):
+        """Built static files get hashed URLs, long caching and gzip."""
+        static_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_folder)
+        shutil.copytree(app.static_folder, static_folder, dirs_exist_ok = True)
+        built = assets.build(static_folder)
+        self.addCleanup(assets.load_manifest, app.static_folder)
+
+        original_static_folder = app.static_folder
+        app.static_folder = static_folder
+        self.addCleanup(setattr, app, 'static_folder', original_static_folder)
+        assets.load_manifest(static_folder)
+
+        html = self.client.get('/login').data.decode("utf-8")
+        css_url = f"/static/{built['stylesheets/style.css']}"
+        css = self.client.get(css_url, headers={'Accept-Encoding': 'gzip'})
+        plain = self.client.get(css_url)
+
+        self.assertIn(css_url, html)
+        self.assertEqual(css.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(css.headers['Content-Type'], 'text/css; charset=utf-8')
+        self.assertIn('immutable', css.headers['Cache-Control'])
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn(built['images/nav-bg.png'], plain.data.decode("utf-8"))
+        css.close()
+        plain.close()
+
+        # Users' images are stored by their canonical path, and fingerprinted
+        # as they are shown.
+        user = User.signup(email = 'pictured@gmail.com', username = 'pictured', image_url = None, password = 'password')
+        db.session.commit()
+        user_id = user.id
+        profile = self.client.get(f'/users/{user_id}').data.decode("utf-8")
+        listed = self.client.get('/api/v1/users/search?q=pictured').get_json()
+
+        self.assertEqual(User.query.get(user_id).image_url, '/static/images/default-pic.png')
+        self.assertIn(f"/static/{built['images/default-pic.png']}", profile)
+        self.assertIn(f"/static/{built['images/warbler-hero.jpg']}", profile)
+        self.assertEqual(listed['data'][0]['image_url'], f"/static/{built['images/default-pic.png']}")
+
+    def test_compression(self):
+        """Pages are gzipped, streamed ones included; images are not."""
+        testuser_id = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            home = c.get('/', headers={'Accept-Encoding': 'gzip'})
+            plain_home = c.get('/')
+            image = c.get('/static/images/default-pic.png', headers={'Accept-Encoding': 'gzip'})
+            with patch.dict(app.config, {'COMPRESSION_MIN_SIZE': 10 ** 6}):
+                small = c.get('/', headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(home.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', home.headers['Vary'])
+            self.assertEqual(gzip.decompress(home.data), plain_home.data)
+            self.assertNotIn('Content-Encoding', image.headers)
+            self.assertNotIn('Content-Encoding', small.headers)
+            image.close()
+
     def test_delete_user(self):
+        user_id = self.testuser.id
+        user2_id = User.query.filter_by(username='user2').one().id
+        msg = Message(text='going away', user_id=user_id)
+        db.session.add(msg)
+        db.session.flush()
+        kept = Message(text='staying', user_id=user2_id)
+        db.session.add(kept)
+        db.session.flush()
+        kept_id = kept.id
+        db.session.add(Likes(user_id=user2_id, message_id=msg.id))
+        db.session.add(Likes(user_id=user_id, message_id=kept_id))
+        db.session.add(Likes(user_id=user2_id, message_id=kept_id))
+        db.session.add(Follows(user_being_followed_id=user_id, user_following_id=user2_id))
+        db.session.commit()
+        counters.recount()
+        counters.recount_likes()
+        db.session.commit()
+
         with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.testuser.id
             resp = c.post('/users/delete', follow_redirects = True)
             html = resp.data.decode("utf-8")
-            total_users = User.query.all()
+            total_users = User.query.filter(User.deleted_at.is_(None)).all()
             """the test will look that there is only one user in the database - user2, our test user has been deleted.
             Also that we are redirecting to the signup page."""
             self.assertIn('Join Warbler today.', html)
             self.assertEqual(len(total_users), 1)
+            self.assertEqual(c.get(f'/users/{user_id}').status_code, 404)
+            self.assertFalse(User.authenticate('user1', 'user1password'))
+
+        # The rest goes in the background.
+        with app.app_context():
+            self.assertEqual(jobs.run_pending(), 1)
+        db.session.expire_all()
+        self.assertEqual(User.query.count(), 1)
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(Follows.query.count(), 0)
+        user2 = User.query.get(user2_id)
+        self.assertEqual((user2.likes_count, user2.following_count), (1, 0))
+        self.assertEqual(Message.query.get(kept_id).like_count, 1)
     
+    def test_purge_race(self):
+        """A purge only adjusts counters for rows it deleted itself, not ones
+        another run of it deleted first."""
+        user_id = self.testuser.id
+        user2_id = User.query.filter_by(username='user2').one().id
+        db.session.add(Follows(user_being_followed_id=user2_id, user_following_id=user_id))
+        db.session.commit()
+
+        execute = db.session.execute
+        def deleted_elsewhere_first(statement, *args, **kwargs):
+            with db.get_engine(app).begin() as other:
+                other.execute(text("DELETE FROM follows"))
+            return execute(statement, *args, **kwargs)
+
+        adjusted = []
+        with app.app_context(), patch.object(db.session, 'execute', deleted_elsewhere_first):
+            deleted = deletion.delete_batches(
+                Follows, [Follows.user_being_followed_id, Follows.user_following_id],
+                Follows.user_following_id == user_id, 10, adjusted.extend)
+
+        self.assertEqual(deleted, 0)
+        self.assertEqual(adjusted, [])
+
+    def test_signup_again_after_delete(self):
+        """A deleted account's username and email are free at once, before
+        the purge runs."""
+        user_id = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post('/users/delete')
+            resp = c.post('/signup', data={"username": "user1",
+                                           "email": "user1@gmail.com",
+                                           "password": "newpassword"})
+
+            self.assertEqual(resp.status_code, 302)
+            again = User.query.filter_by(username='user1').one()
+            self.assertNotEqual(again.id, user_id)
+            self.assertEqual(again.email, 'user1@gmail.com')
+            self.assertTrue(User.authenticate('user1', 'newpassword'))
+
+    def test_job_retries(self):
+        """A failing job is retried later, then given up on."""
+        def fail(**payload):
+            raise RuntimeError("try again")
+
+        with app.app_context(), \
+                patch.dict(jobs.handlers, {'test.fail': fail}), \
+                patch.dict(app.config, {'JOBS_MAX_ATTEMPTS': 2}):
+            jobs.enqueue('test.fail', n=1)
+            db.session.commit()
+            self.assertEqual(jobs.run_pending(), 1)
+            job = Job.query.one()
+            self.assertEqual(job.attempts, 1)
+            self.assertIn("try again", job.last_error)
+            self.assertIsNone(job.failed_at)
+            # Not due again until the backoff has passed.
+            self.assertEqual(jobs.run_pending(), 0)
+
+            Job.query.update({Job.run_at: Job.run_at - timedelta(hours=1)})
+            db.session.commit()
+            self.assertEqual(jobs.run_pending(), 1)
+            job = Job.query.one()
+            self.assertEqual(job.attempts, 2)
+            self.assertIsNotNone(job.failed_at)
+            self.assertEqual(jobs.run_pending(), 0)
+
+    def test_engine_options(self):
+        """Pool sizing is only passed to dialects whose pool takes it."""
+        self.assertIn('pool_size', engine_options('postgresql:///warbler'))
+        self.assertNotIn('pool_size', engine_options('sqlite://'))
+
+    def test_read_replica(self):
+        """GET views read from a replica, except right after a write."""
+        testuser_id = self.testuser.id
+        # A second, read-only connection to the test database stands in for a replica.
+        replica_uri = app.config['SQLALCHEMY_DATABASE_URI'] + '?application_name=replica'
+        with patch.dict(app.config, {'SQLALCHEMY_REPLICA_URIS': [replica_uri]}):
+            [replica] = replicas.replica_engines.for_app(app)
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            event.listen(replica, 'before_cursor_execute', listener)
+            self.addCleanup(event.remove, replica, 'before_cursor_execute', listener)
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser_id
+                c.get(f'/users/{testuser_id}').get_data()
+                read = len(statements)
+                c.post('/messages/new', data={"text": "fresh"})
+                written = len(statements)
+                fresh = c.get(f'/users/{testuser_id}').get_data(as_text=True)
+                after_write = len(statements)
+                with patch.dict(app.config, {'REPLICA_LAG_WINDOW': 0}):
+                    c.get(f'/users/{testuser_id}').get_data()
+
+            self.assertGreater(read, 0)
+            self.assertEqual(written, read)
+            self.assertIn('fresh', fresh)
+            self.assertEqual(after_write, read)
+            self.assertGreater(len(statements), read)
+
+            with replica.connect() as conn, self.assertRaises(InternalError):
+                conn.execute("UPDATE users SET bio = 'nope'")
+
     def test_delete_user_logged_out(self):
         with self.client as c:
             resp = c.post('/users/delete', follow_redirects = True)
@@ -0,0 +1,236 @@
+"""Precomputed home timelines for Warbler.
+
+New messages are pushed ("fanned out") into a row per follower in
+``timeline_entries``, so the homepage is a single indexed range read instead
+of a scan over every message by every followed user.
+
+Authors with more than ``TIMELINE_FANOUT_LIMIT`` followers are not pushed:
+copying each of their messages to every follower would be too expensive.
+Their messages are pulled in when the timeline is read instead. An author
+who drops back to the limit is pushed again, and their followers' timelines
+are backfilled with the messages that were only pulled meanwhile. (Raising
+the limit itself takes a `rebuild`.)
+
+Pushing a message and backfilling a new follower's timeline run as
+background jobs, after the request that caused them. Either may also run
+twice or overlap with the other, so they skip entries that already exist.
+"""
+
+from flask import current_app
+from sqlalchemy import func, literal
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
+
+import jobs
+import pagination
+from models import db, User, Follows, Message, TimelineEntry
+
+DEFAULT_FANOUT_LIMIT = 10000
+DEFAULT_BACKFILL = 100
+
+
+def fanout_limit():
+    """Followers above which an author's messages are pulled, not pushed."""
+
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', DEFAULT_FANOUT_LIMIT)
+
+
+def is_pulled_author(user_id):
+    """Are `user_id`'s messages read at request time rather than pushed?"""
+
+    followers = (db.session
+                 .query(User.followers_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+    return (followers or 0) > fanout_limit()
+
+
+def insert_entries(select):
+    """Insert the (user_id, message_id) rows of `select`, if new."""
+
+    db.session.execute(
+        insert(TimelineEntry.__table__)
+        .from_select(['user_id', 'message_id'], select)
+        .on_conflict_do_nothing())
+
+
+@jobs.handler('timeline.push_message')
+def push_message(message_id):
+    """Copy a new message into the timeline of each of its author's followers."""
+
+    msg = Message.query.get(message_id)
+    if msg is None or is_pulled_author(msg.user_id):
+        return
+
+    followers = (db.session
+                 .query(Follows.user_following_id, literal(msg.id))
+                 .filter(Follows.user_being_followed_id == msg.user_id))
+    insert_entries(followers)
+
+
+@jobs.handler('timeline.add_follow')
+def add_follow(follower_id, followed_id):
+    """Backfill `follower_id`'s timeline with recent messages by `followed_id`."""
+
+    if is_pulled_author(followed_id):
+        return
+    if Follows.query.get((followed_id, follower_id)) is None:
+        # Unfollowed again before the job ran.
+        return
+
+    backfill = current_app.config.get('TIMELINE_BACKFILL', DEFAULT_BACKFILL)
+    recent = (db.session
+              .query(literal(follower_id), Message.id)
+              .filter(Message.user_id == followed_id)
+              .order_by(Message.id.desc())
+              .limit(backfill))
+    insert_entries(recent)
+
+
+def followers_dropped(user_ids):
+    """Queue a backfill for any of `user_ids` now back at the fan-out limit.
+
+    Call after their ``followers_count`` went down by one, in the same
+    transaction.
+    """
+
+    back = (db.session
+            .query(User.id)
+            .filter(User.id.in_(user_ids),
+                    User.followers_count == fanout_limit())
+            .all())
+    for (author_id,) in back:
+        jobs.enqueue('timeline.push_author', author_id=author_id)
+
+
+@jobs.handler('timeline.push_author')
+def push_author(author_id):
+    """Backfill every follower's timeline with recent messages by `author_id`.
+
+    For an author who is pushed again after a time of being pulled, when
+    their new messages reached no timelines.
+    """
+
+    if is_pulled_author(author_id):
+        return
+
+    backfill = current_app.config.get('TIMELINE_BACKFILL', DEFAULT_BACKFILL)
+    recent = (db.session
+              .query(Message.id)
+              .filter(Message.user_id == author_id)
+              .order_by(Message.id.desc())
+              .limit(backfill)
+              .subquery())
+    entries = (db.session
+               .query(Follows.user_following_id, recent.c.id)
+               .filter(Follows.user_being_followed_id == author_id))
+    insert_entries(entries)
+
+
+def remove_follow(follower_id, followed_id):
+    """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+    authored = (db.session
+                .query(Message.id)
+                .filter(Message.user_id == followed_id)
+                .subquery())
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == follower_id,
+             TimelineEntry.message_id.in_(authored))
+     .delete(synchronize_session=False))
+
+
+def remove_message(message_id):
+    """Drop a message from every timeline it was pushed to."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.message_id == message_id)
+     .delete(synchronize_session=False))
+
+
+def pulled_authors(user_id):
+    """Ids of users `user_id` follows whose messages are not pushed."""
+
+    return [author_id for (author_id,) in (
+        db.session
+        .query(User.id)
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user_id,
+                User.followers_count > fanout_limit())
+        .all())]
+
+
+def messages_query(columns=None):
+    """Query for messages, or for just `columns` of them and their authors.
+
+    Messages of deleted accounts are left out; they are purged later.
+    """
+
+    if columns is None:
+        query = Message.query
+    else:
+        query = db.session.query(*columns).select_from(Message)
+    return (query
+            .join(User, User.id == Message.user_id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def home_messages(user_id, limit=100, cursor=None, columns=None):
+    """Messages for `user_id`'s home timeline, newest first.
+
+    `cursor` is an (id,) key from `pagination`; only older messages
+    are returned. Messages come with their authors loaded, or, if `columns`
+    (of Message and User) are given, as rows of just those.
+    """
+
+    pushed = (messages_query(columns)
+              .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+              .filter(TimelineEntry.user_id == user_id))
+    pushed = pagination.before(pushed, cursor, TimelineEntry.message_id)
+
+    authors = pulled_authors(user_id)
+    if not authors:
+        query = pushed.order_by(TimelineEntry.message_id.desc())
+    else:
+        pulled = messages_query(columns).filter(Message.user_id.in_(authors))
+        pulled = pagination.before(pulled, cursor, Message.id)
+        query = pushed.union(pulled).order_by(Message.id.desc())
+
+    if columns is None:
+        query = query.options(joinedload(Message.user))
+    return query.limit(limit).all()
+
+
+def rebuild(backfill=None):
+    """Recompute every timeline from the follows and messages tables."""
+
+    if backfill is None:
+        backfill = current_app.config.get('TIMELINE_BACKFILL', DEFAULT_BACKFILL)
+
+    TimelineEntry.query.delete(synchronize_session=False)
+
+    pushed_authors = (db.session
+                      .query(User.id)
+                      .filter(User.followers_count <= fanout_limit())
+                      .subquery())
+
+    recent = (db.session
+              .query(Message.id,
+                     Message.user_id,
+                     func.row_number().over(
+                         partition_by=Message.user_id,
+                         order_by=Message.id.desc()).label('position'))
+              .filter(Message.user_id.in_(pushed_authors))
+              .subquery())
+
+    entries = (db.session
+               .query(Follows.user_following_id, recent.c.id)
+               .join(recent, recent.c.user_id == Follows.user_being_followed_id)
+               .filter(recent.c.position <= backfill))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id'], entries))
@@ -0,0 +1,140 @@
+"""Cheap loading of the logged-in user.
+
+`lazy_user` gives `g.user` as a proxy that only loads the user when it is
+actually used, so requests that never touch it (static files, redirects)
+skip the database entirely. Loads go through `user_rows`, a small LRU of
+user column values with a short time-to-live, so most requests that do use
+it still don't query for it.
+
+Cached rows are dropped whenever the user row changes through the ORM, and
+explicitly by writes that bypass it (such as counter updates). That only
+reaches this process's cache, so another worker's copy can trail the
+database by up to ``USER_CACHE_TTL`` seconds. Pages can live with that;
+requests that change data use ``lazy_user(user_id, fresh=True)``, which
+reads the row from the database and refreshes the cached copy.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.local import LocalProxy
+
+from models import db, User
+
+DEFAULT_TTL = 30
+DEFAULT_SIZE = 1024
+
+
+class UserRowCache:
+    """Size-bounded, time-limited LRU cache of user column values by id."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = OrderedDict()
+
+    def get(self, user_id):
+        """Cached column values for `user_id`, or None if absent or expired."""
+
+        with self.lock:
+            entry = self.rows.get(user_id)
+            if entry is None:
+                return None
+            expires, row = entry
+            if expires < time.monotonic():
+                del self.rows[user_id]
+                return None
+            self.rows.move_to_end(user_id)
+            return row
+
+    def put(self, user_id, row):
+        ttl = current_app.config.get('USER_CACHE_TTL', DEFAULT_TTL)
+        size = current_app.config.get('USER_CACHE_SIZE', DEFAULT_SIZE)
+        if ttl <= 0 or size <= 0:
+            return
+
+        with self.lock:
+            self.rows[user_id] = (time.monotonic() + ttl, row)
+            self.rows.move_to_end(user_id)
+            while len(self.rows) > size:
+                self.rows.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.rows.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+
+user_rows = UserRowCache()
+
+
+def load_user(user_id, fresh=False):
+    """User `user_id` in the current session, without a query if cached.
+
+    With `fresh`, always read from the database, overwriting any copy
+    already in the session. Returns None if there is no such user, or they
+    deleted their account.
+    """
+
+    row = None if fresh else user_rows.get(user_id)
+    if row is None:
+        user = User.query.populate_existing().get(user_id)
+        if user is None:
+            return None
+        row = {attr.key: getattr(user, attr.key)
+               for attr in inspect(User).column_attrs}
+        user_rows.put(user_id, row)
+        return user if user.deleted_at is None else None
+
+    if row['deleted_at'] is not None:
+        return None
+
+    # Attach the cached values to the session as an already-persistent,
+    # unmodified instance; relationships still lazy-load as usual.
+    user = User(**row)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+class _UserLoader:
+    """Loads a user on first call and remembers the result."""
+
+    def __init__(self, user_id, fresh):
+        self.user_id = user_id
+        self.fresh = fresh
+        self.loaded = False
+        self.user = None
+
+    def __call__(self):
+        if not self.loaded:
+            self.user = load_user(self.user_id, self.fresh)
+            self.loaded = True
+        return self.user
+
+
+def lazy_user(user_id, fresh=False):
+    """Proxy for user `user_id` that loads them on first use.
+
+    Like the user itself, it is falsy if no such user exists. `fresh` is
+    passed on to `load_user`.
+    """
+
+    return LocalProxy(_UserLoader(user_id, fresh))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_cached_row(mapper, connection, user):
+    user_rows.invalidate(user.id)
+
+
+@event.listens_for(db.session, 'after_bulk_delete')
+def forget_deleted_rows(delete_context):
+    if delete_context.mapper.class_ is User:
+        user_rows.clear()
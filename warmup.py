@@ -0,0 +1,109 @@
+"""Getting a preloaded app ready before it serves traffic.
+
+In production gunicorn imports the app once, in the master process, and
+forks its workers from it (see gunicorn.conf.py and wsgi.py). What `warm`
+does there is shared by every worker, copy-on-write, so no worker's first
+request pays for it:
+
+- every Jinja template is compiled;
+- SQLAlchemy mappers are configured;
+- the in-process username search index is loaded, where search uses it;
+- cards for the newest ``WARMUP_CARDS`` messages are rendered into the
+  fragment cache.
+
+Database connections must not be shared across a fork, so `warm` closes
+the ones it opened, and each worker opens its own pools in `after_fork`,
+before it accepts a request. Each step's time is logged to
+``warbler.boot``.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+from sqlalchemy.orm import configure_mappers, joinedload
+
+from models import db, Message
+from replicas import replica_engines
+import fragments
+import search
+import snowflake
+import timeline
+
+boot_log = logging.getLogger('warbler.boot')
+
+DEFAULT_WARMUP_CARDS = 1000
+
+
+@contextmanager
+def timed(timings, step):
+    started = time.perf_counter()
+    yield
+    timings[step] = time.perf_counter() - started
+
+
+def compile_templates(app):
+    """Load and compile every template. Returns how many there are."""
+
+    names = app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def render_cards(limit):
+    """Cache the cards of the newest `limit` messages."""
+
+    messages = (timeline
+                .messages_query()
+                .options(joinedload(Message.user))
+                .order_by(Message.id.desc())
+                .limit(limit)
+                .all())
+    for message in messages:
+        fragments.message_card(message)
+    return len(messages)
+
+
+def release_connections(app):
+    """Close every pooled connection of `app`, primary and replicas."""
+
+    with app.app_context():
+        db.engine.dispose()
+    replica_engines.dispose()
+
+
+def warm(app):
+    """Do `app`'s first-request work now. Returns each step's seconds."""
+
+    timings = {}
+    with timed(timings, 'templates'):
+        compile_templates(app)
+    with timed(timings, 'mappers'):
+        configure_mappers()
+
+    with app.app_context():
+        with timed(timings, 'search index'):
+            if not search.has_trigram_index():
+                search.username_index.load()
+        with timed(timings, 'cards'):
+            render_cards(app.config.get('WARMUP_CARDS', DEFAULT_WARMUP_CARDS))
+        db.session.remove()
+
+    release_connections(app)
+
+    boot_log.info("Warmed up in %.2fs (%s)", sum(timings.values()),
+                  ', '.join(f"{step} {seconds:.2f}s" for step, seconds in timings.items()))
+    return timings
+
+
+def after_fork(app, worker_number=0):
+    """Set up a freshly forked worker: its message id range and its own
+    database connections, one opened per engine ahead of the first request."""
+
+    snowflake.init_app(app, worker_number)
+
+    with app.app_context():
+        engines = [db.engine] + replica_engines.for_app(app)
+    for engine in engines:
+        engine.connect().close()
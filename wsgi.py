@@ -0,0 +1,17 @@
+"""Production entry point: ``gunicorn -c gunicorn.conf.py wsgi:app``.
+
+Builds the app with settings from the environment and warms it up (see
+`warmup`) before the server forks its workers. The time from here to a
+warm app, imports included, is logged to ``warbler.boot``.
+"""
+
+import time
+
+started = time.perf_counter()
+
+from app import create_app  # noqa: E402
+import warmup  # noqa: E402
+
+app = create_app()
+warmup.warm(app)
+warmup.boot_log.info("App ready in %.2fs", time.perf_counter() - started)